@@ -0,0 +1,104 @@
+# coding=utf-8
+"""Micro-benchmark comparing np.ma.where-based pasting with in-place pasting.
+
+Usage (with marblecutter installed, e.g. `pip install -e .`):
+
+    python benchmarks/paste.py [--repeat N]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import timeit
+
+import numpy as np
+
+from marblecutter.mosaic import paste
+from marblecutter.utils import Bounds, PixelCollection
+
+BOUNDS = Bounds((0, 0, 1, 1), None)
+SIZES = (256, 512, 1024)
+SOURCE_COUNTS = (1, 2, 5, 10, 15)
+
+
+def paste_where(window_pixels, canvas_pixels):
+    """The previous implementation, which allocates a new canvas per paste."""
+    window_data = window_pixels.data
+    canvas = canvas_pixels.data
+
+    merged = np.ma.where(canvas.mask & ~window_data.mask, window_data, canvas)
+    merged.fill_value = canvas.fill_value
+
+    return PixelCollection(merged, canvas_pixels.bounds)
+
+
+def make_windows(size, count, dtype=np.uint8):
+    rng = np.random.RandomState(size + count)
+    windows = []
+
+    for _ in range(count):
+        data = rng.randint(0, 255, (3, size, size)).astype(dtype)
+        # each source covers a random ~40% of the canvas
+        mask = np.repeat(rng.rand(1, size, size) > 0.4, 3, axis=0)
+        windows.append(PixelCollection(np.ma.masked_array(data, mask=mask), BOUNDS))
+
+    return windows
+
+
+def make_canvas(size, dtype=np.uint8):
+    data = np.ma.zeros((3, size, size), dtype=dtype)
+    data.mask = True
+
+    return PixelCollection(data, BOUNDS)
+
+
+def run(fn, windows, size, cast):
+    canvas = make_canvas(size)
+
+    for window in windows:
+        if cast:
+            # the previous compositing loop cast every window to the canvas dtype
+            window = PixelCollection(window.data.astype(canvas.data.dtype), BOUNDS)
+
+        canvas = fn(window, canvas)
+
+    return canvas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:>6} {:>7} {:>10} {:>12} {:>8}".format(
+        "size", "sources", "where (ms)", "inplace (ms)", "speedup"))
+
+    for size in SIZES:
+        for count in SOURCE_COUNTS:
+            windows = make_windows(size, count)
+
+            expected = run(paste_where, windows, size, True).data
+            actual = run(paste, windows, size, False).data
+            assert (expected.mask == actual.mask).all()
+            assert (expected.filled() == actual.filled()).all()
+
+            where = min(
+                timeit.repeat(
+                    lambda: run(paste_where, windows, size, True),
+                    number=1,
+                    repeat=args.repeat,
+                )
+            )
+            inplace = min(
+                timeit.repeat(
+                    lambda: run(paste, windows, size, False),
+                    number=1,
+                    repeat=args.repeat,
+                )
+            )
+
+            print("{:>6} {:>7} {:>10.2f} {:>12.2f} {:>7.1f}x".format(
+                size, count, where * 1000, inplace * 1000, where / inplace))
+
+
+if __name__ == "__main__":
+    main()
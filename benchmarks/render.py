@@ -0,0 +1,448 @@
+# coding=utf-8
+"""Benchmark render_tile across formats, transformations and source counts.
+
+Synthetic, cloud-optimized GeoTIFFs (varying dtypes, band counts, CRSes,
+overviews and masks) are generated into a data directory (and reused on
+subsequent runs) and served from an in-memory catalog. Latency percentiles and
+throughput for each scenario are written as JSON so that runs can be compared.
+
+Usage (with marblecutter installed, e.g. `pip install -e .`):
+
+    python benchmarks/render.py [--output results.json] [--compare baseline.json]
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+import mercantile
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio import warp
+from rasterio.crs import CRS
+from rasterio.transform import from_bounds
+
+from marblecutter import NoDataAvailable
+from marblecutter.catalogs import WGS84_CRS, Catalog
+from marblecutter.formats.geotiff import GeoTIFF
+from marblecutter.formats.jpeg import JPEG
+from marblecutter.formats.optimal import Optimal
+from marblecutter.formats.png import PNG
+from marblecutter.formats.webp import WebP
+from marblecutter.stats import clock
+from marblecutter.tiling import render_tile
+from marblecutter.transformations import Greyscale, Image
+from marblecutter.utils import Source
+
+# area covered by synthetic sources (west, south, east, north)
+EXTENT = (-74.2, 40.5, -73.7, 40.9)
+ZOOMS = (10, 12, 14)
+SIZE = 2048
+CRSES = (
+    CRS.from_epsg(3857),
+    CRS.from_epsg(4326),
+    # UTM zone 18N
+    CRS.from_epsg(32618),
+)
+FORMATS = {
+    "geotiff": GeoTIFF,
+    "jpeg": JPEG,
+    "optimal": Optimal,
+    "optimal-webp": lambda: Optimal(opaque=WebP(), transparent=WebP()),
+    "png": PNG,
+    "webp": WebP,
+}
+TRANSFORMATIONS = {"greyscale": Greyscale, "image": Image, "raw": lambda: None}
+# (format, transformation, kind of source)
+SCENARIOS = (
+    ("png", "image", "rgb"),
+    ("jpeg", "image", "rgb"),
+    ("optimal", "image", "rgb"),
+    ("webp", "image", "rgb"),
+    ("optimal-webp", "image", "rgb"),
+    ("geotiff", "raw", "rgb"),
+    ("png", "greyscale", "grey"),
+    ("geotiff", "raw", "dem"),
+)
+SOURCE_COUNTS = (1, 2, 5, 10)
+
+
+class MemoryCatalog(Catalog):
+    """Serves sources held in memory."""
+
+    def __init__(self, sources):
+        self._sources = sources
+
+    def get_sources(self, bounds, resolution, deadline=None):
+        if bounds.crs == WGS84_CRS:
+            w, s, e, n = bounds.bounds
+        else:
+            w, s, e, n = warp.transform_bounds(bounds.crs, WGS84_CRS, *bounds.bounds)
+
+        for source in self._sources:
+            left, bottom, right, top = source.meta["bounds"]
+            if left < e and right > w and bottom < n and top > s:
+                yield source
+
+
+def _pattern(rng, count, shape, dtype):
+    """Generate smooth-ish (compressible, like imagery) data."""
+    y, x = np.mgrid[0:shape[0], 0:shape[1]] / float(max(shape))
+    bands = []
+
+    for _ in range(count):
+        fx, fy, phase = rng.uniform(2, 12), rng.uniform(2, 12), rng.uniform(0, 6)
+        band = np.sin(x * fx + phase) * np.cos(y * fy) + rng.normal(0, 0.05, shape)
+        bands.append(band)
+
+    data = (np.array(bands) + 1.1) / 2.2
+
+    if np.issubdtype(dtype, np.integer):
+        data = data * np.iinfo(dtype).max
+
+    return data.clip(0, None).astype(dtype)
+
+
+def _blob_mask(rng, shape, coverage):
+    """Generate a dataset mask (255 = valid) with blobby holes."""
+    y, x = np.mgrid[0:shape[0], 0:shape[1]] / float(max(shape))
+    field = np.zeros(shape)
+    for _ in range(6):
+        cx, cy, r = rng.uniform(0, 1), rng.uniform(0, 1), rng.uniform(0.1, 0.4)
+        field += np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / r ** 2)
+
+    threshold = np.percentile(field, 100 * (1 - coverage))
+
+    return np.where(field >= threshold, 255, 0).astype(np.uint8)
+
+
+def make_cog(path, crs, count, dtype, rng, nodata=None, mask_coverage=None):
+    """Write a tiled, compressed GeoTIFF with overviews covering EXTENT."""
+    bounds = warp.transform_bounds(WGS84_CRS, crs, *EXTENT)
+    height = width = SIZE
+    if crs.is_geographic:
+        height = int(SIZE * (bounds[3] - bounds[1]) / (bounds[2] - bounds[0]))
+
+    data = _pattern(rng, count, (height, width), dtype)
+    if nodata is not None:
+        data[:, : height // 8, : width // 8] = nodata
+
+    profile = {
+        "driver": "GTiff",
+        "count": count,
+        "dtype": dtype,
+        "crs": crs,
+        "height": height,
+        "width": width,
+        "transform": from_bounds(*bounds, width=width, height=height),
+        "nodata": nodata,
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    }
+
+    tmp = path + ".tmp.tif"
+    with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+        with rasterio.open(tmp, "w", **profile) as dst:
+            dst.write(data)
+            if mask_coverage is not None:
+                dst.write_mask(_blob_mask(rng, (height, width), mask_coverage))
+
+        with rasterio.open(tmp, "r+") as dst:
+            dst.build_overviews([2, 4, 8, 16], warp.Resampling.average)
+
+        rasterio.shutil.copy(
+            tmp,
+            path,
+            driver="GTiff",
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+            copy_src_overviews=True,
+        )
+
+    os.unlink(tmp)
+
+
+def make_sources(data_dir, max_count):
+    """Generate (or reuse) synthetic sources.
+
+    Returns:
+        dict -- Lists of sources keyed by kind ("rgb", "grey", "dem").
+    """
+    sources = {"rgb": [], "grey": [], "dem": []}
+    w, s, e, n = EXTENT
+    # an ellipse to mask out of some sources (exercising source masks)
+    ellipse = {
+        "type": "Polygon",
+        "coordinates": [
+            [
+                (
+                    w + (e - w) * (0.5 + 0.2 * math.cos(t)),
+                    s + (n - s) * (0.5 + 0.2 * math.sin(t)),
+                )
+                for t in np.linspace(0, 2 * math.pi, 200)
+            ]
+        ],
+    }
+
+    specs = [
+        (
+            "rgb",
+            "rgb-{}".format(i),
+            dict(
+                crs=CRSES[i % len(CRSES)], count=3, dtype=np.uint8, mask_coverage=0.6
+            ),
+        )
+        for i in range(max_count)
+    ] + [
+        ("grey", "grey", dict(crs=CRSES[0], count=1, dtype=np.uint8, nodata=0)),
+        ("dem", "dem", dict(crs=CRSES[2], count=1, dtype=np.float32, nodata=-9999.0)),
+    ]
+
+    for i, (kind, name, spec) in enumerate(specs):
+        path = os.path.join(data_dir, name + ".tif")
+
+        if not os.path.exists(path):
+            print("Generating {}".format(path), file=sys.stderr)
+            # seed per source so that outputs don't depend on what's been
+            # generated previously
+            make_cog(path, rng=np.random.RandomState(i), **spec)
+
+        sources[kind].append(
+            Source(
+                path,
+                name,
+                None,
+                {},
+                {"bounds": EXTENT},
+                {"imagery": True} if kind == "rgb" else {},
+                # no footprints: sources cover EXTENT but have dataset-mask
+                # holes, so none of them may be pruned and each source count
+                # composites that many sources
+                # mask every other RGB source
+                mask=ellipse if kind == "rgb" and len(sources[kind]) % 2 else None,
+            )
+        )
+
+    return sources
+
+
+def tiles(count):
+    """Select tiles within EXTENT (deterministically) at each zoom."""
+    selected = []
+    rng = np.random.RandomState(1)
+
+    for zoom in ZOOMS:
+        candidates = list(mercantile.tiles(*EXTENT, zooms=zoom))
+        for i in rng.permutation(len(candidates))[:count]:
+            selected.append(candidates[i])
+
+    return selected
+
+
+def benchmark(catalog, tiles, format, transformation, repeat):
+    # warm up (opening datasets, populating caches)
+    for tile in tiles:
+        try:
+            render_tile(tile, catalog, format=format, transformation=transformation)
+        except NoDataAvailable:
+            pass
+
+    latencies = []
+    nodata = 0
+    start = clock()
+
+    for _ in range(repeat):
+        for tile in tiles:
+            t = clock()
+            try:
+                render_tile(tile, catalog, format=format, transformation=transformation)
+            except NoDataAvailable:
+                nodata += 1
+            latencies.append(clock() - t)
+
+    elapsed = clock() - start
+    latencies = np.array(latencies) * 1000
+
+    return {
+        "renders": len(latencies),
+        "no_data": nodata,
+        "tiles_per_second": len(latencies) / elapsed,
+        "mean_ms": float(latencies.mean()),
+        "min_ms": float(latencies.min()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p90_ms": float(np.percentile(latencies, 90)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "max_ms": float(latencies.max()),
+    }
+
+
+def environment():
+    try:
+        revision = (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.STDOUT,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except Exception:
+        revision = None
+
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "cpus": os.cpu_count() if hasattr(os, "cpu_count") else None,
+    }
+
+
+def compare(results, baseline):
+    previous = dict((r["scenario"], r) for r in baseline["results"])
+
+    print(
+        "\n{:<28} {:>10} {:>10} {:>8} {:>10} {:>10} {:>8}".format(
+            "scenario", "p50 (ms)", "was", "change", "p99 (ms)", "was", "change"
+        )
+    )
+
+    for result in results:
+        old = previous.get(result["scenario"])
+        if old is None or "error" in old or "error" in result:
+            continue
+
+        print(
+            "{:<28} {:>10.2f} {:>10.2f} {:>+7.1f}% "
+            "{:>10.2f} {:>10.2f} {:>+7.1f}%".format(
+                result["scenario"],
+                result["p50_ms"],
+                old["p50_ms"],
+                100 * (result["p50_ms"] / old["p50_ms"] - 1),
+                result["p99_ms"],
+                old["p99_ms"],
+                100 * (result["p99_ms"] / old["p99_ms"] - 1),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "marblecutter-benchmarks"),
+        help="Directory to generate sources in (reused if present)",
+    )
+    parser.add_argument("--output", help="File to write JSON results to")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--tiles", type=int, default=8, help="Number of tiles per zoom level"
+    )
+    parser.add_argument(
+        "--formats",
+        default=",".join(sorted(FORMATS)),
+        help="Comma-separated formats to benchmark",
+    )
+    parser.add_argument(
+        "--sources",
+        default=",".join(map(str, SOURCE_COUNTS)),
+        help="Comma-separated source counts to benchmark (RGB scenarios)",
+    )
+    args = parser.parse_args()
+
+    formats = args.formats.split(",")
+    source_counts = [int(x) for x in args.sources.split(",")]
+
+    if not os.path.isdir(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    sources = make_sources(args.data_dir, max(source_counts))
+    selected = tiles(args.tiles)
+    results = []
+
+    print(
+        "{:<28} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "scenario", "renders", "tiles/s", "p50 (ms)", "p90 (ms)", "p99 (ms)"
+        )
+    )
+
+    for format_name, transformation_name, kind in SCENARIOS:
+        if format_name not in formats:
+            continue
+
+        for count in source_counts if kind == "rgb" else (1,):
+            catalog = MemoryCatalog(sources[kind][:count])
+            result = {
+                "scenario": "{}/{}/{}x{}".format(
+                    format_name, transformation_name, count, kind
+                ),
+                "format": format_name,
+                "transformation": transformation_name,
+                "source_kind": kind,
+                "sources": count,
+            }
+            try:
+                result.update(
+                    benchmark(
+                        catalog,
+                        selected,
+                        FORMATS[format_name](),
+                        TRANSFORMATIONS[transformation_name](),
+                        args.repeat,
+                    )
+                )
+            except Exception as e:
+                # record unsupported combinations rather than aborting the run
+                result["error"] = "{}: {}".format(type(e).__name__, e)
+                results.append(result)
+                print("{:<28} {}".format(result["scenario"], result["error"]))
+                continue
+
+            results.append(result)
+
+            print(
+                "{:<28} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                    result["scenario"],
+                    result["renders"],
+                    result["tiles_per_second"],
+                    result["p50_ms"],
+                    result["p90_ms"],
+                    result["p99_ms"],
+                )
+            )
+
+    output = {
+        "environment": environment(),
+        "parameters": {
+            "repeat": args.repeat,
+            "tiles": [tuple(t) for t in selected],
+            "size": SIZE,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
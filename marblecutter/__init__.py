@@ -4,30 +4,45 @@ from __future__ import absolute_import, division, print_function
 from builtins import str
 import logging
 import math
+import os
 import unicodedata
-import itertools
 
 import numpy as np
 
-import rasterio
 from haversine import haversine
 from rasterio import transform, warp, windows
 from rasterio._err import CPLE_OutOfMemoryError
 from rasterio.crs import CRS
 from rasterio.enums import ColorInterp, MaskFlags
-from rasterio.features import geometry_mask
 from rasterio.transform import Affine, from_bounds
 from rasterio.vrt import WarpedVRT
-from rasterio.warp import Resampling, transform_geom
+from rasterio.warp import Resampling
 
 from . import mosaic
-from .stats import Timer
-from .utils import Bounds, PixelCollection
+from .budget import BUDGET, estimate
+from .cache import DatasetCache, LRUCache, fingerprint
+from .masks import get_mask
+from .stats import METRICS, Timer
+from .utils import Bounds, PixelCollection, WarpPlan
 
 EARTH_RADIUS = 6378137
 WEB_MERCATOR_CRS = CRS.from_epsg(3857)
 WGS84_CRS = CRS.from_epsg(4326)
 LOG = logging.getLogger(__name__)
+SOURCE_CACHE = DatasetCache(
+    max_open=int(os.getenv("MARBLECUTTER_SOURCE_CACHE_SIZE", 64)),
+    ttl=int(os.getenv("MARBLECUTTER_SOURCE_CACHE_TTL", 300)),
+)
+WARP_PLAN_CACHE = LRUCache(
+    max_size=int(os.getenv("MARBLECUTTER_WARP_PLAN_CACHE_SIZE", 1024))
+)
+# formatted uniform (single color) images, keyed by format, shape and color
+UNIFORM_CACHE = LRUCache(
+    max_size=int(os.getenv("MARBLECUTTER_UNIFORM_CACHE_SIZE", 64))
+)
+# number of pixels (per axis) compared before scanning whole images for
+# uniformity
+UNIFORM_SAMPLE_SIZE = 16
 
 EXTENTS = {
     str(WEB_MERCATOR_CRS): (
@@ -70,10 +85,137 @@ class DataReadFailed(Exception):
     pass
 
 
+class RenderCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(RenderCancelled):
+    pass
+
+
+class InsufficientMemory(Exception):
+    """Raised when memory for a render isn't available, either because the
+    memory budget is exhausted or because an allocation failed."""
+
+    pass
+
+
+def _escape(name):
+    """Escape a name for use in a Server-Timing description."""
+    return (
+        unicodedata.normalize("NFKD", str(name))
+        .replace('"', '\\"')
+        .encode("ascii", "ignore")
+        .decode("ascii")
+    )
+
+
 def _isimage(data_format):
     return data_format.upper() in ["RGB", "RGBA"]
 
 
+def _isempty(data):
+    """Determine whether image data is fully transparent without scanning it.
+
+    Only constant (zero-stride) images are recognized, as produced by
+    transformations.image.transparent for renders where everything was masked.
+    """
+    return (
+        data.ndim == 3
+        and data.shape[2] == 4
+        and data.strides[:2] == (0, 0)
+        and data[0, 0, 3] == 0
+    )
+
+
+def _isopaque(data):
+    """Determine whether RGBA image data is fully opaque.
+
+    Alpha is checked a block of rows at a time, so (partially) transparent
+    images are usually recognized without scanning all of it.
+    """
+    alpha = data[:, :, 3]
+
+    for i in range(0, alpha.shape[0], 64):
+        if alpha[i:i + 64].min() != 255:
+            return False
+
+    return True
+
+
+def _uniform(data):
+    """Determine the color of image data if every pixel is the same.
+
+    Constant (zero-stride) images are recognized without scanning them; other
+    images are sampled first, so that most are ruled out cheaply.
+
+    Returns:
+        tuple -- Channel values of the color, or None if pixels differ.
+    """
+    if data.ndim != 3 or data.size == 0 or np.ma.is_masked(data):
+        return None
+
+    color = data[0, 0]
+
+    if data.strides[:2] != (0, 0):
+        (height, width, _) = data.shape
+        sample = data[
+            :: max(1, height // UNIFORM_SAMPLE_SIZE),
+            :: max(1, width // UNIFORM_SAMPLE_SIZE),
+        ]
+
+        if (sample != color).any():
+            return None
+
+        if data.flags.c_contiguous:
+            # every pixel matches the next one (much faster than comparing
+            # with color, which is broadcast)
+            flat = data.reshape(-1)
+            if not np.array_equal(flat[data.shape[2]:], flat[: -data.shape[2]]):
+                return None
+        elif (data != color).any():
+            return None
+
+    return tuple(color.tolist())
+
+
+def _format(format, pixels, data_format, sources):
+    """Format pixels, reusing previously formatted output for uniform
+    images.
+
+    Uniform images (fully transparent or a single color) are common at low
+    zooms and around the edges of coverage; their formatted output only
+    depends on the format, shape and color, so it's shared between renders.
+    Raw data is always formatted, as its output is georeferenced.
+    """
+    if not _isimage(data_format):
+        return format(pixels, data_format, sources)
+
+    color = _uniform(pixels.data)
+
+    if color is None:
+        return format(pixels, data_format, sources)
+
+    key = (
+        fingerprint(format),
+        data_format.upper(),
+        str(pixels.data.dtype),
+        pixels.data.shape,
+        color,
+    )
+    formatted = UNIFORM_CACHE.get(key)
+
+    METRICS.increment(
+        "uniform_cache.lookups", result="miss" if formatted is None else "hit"
+    )
+
+    if formatted is None:
+        formatted = format(pixels, data_format, sources)
+        UNIFORM_CACHE.set(key, formatted)
+
+    return formatted
+
+
 def _mask(data, nodata):
     if np.issubdtype(data.dtype, np.floating):
         return np.ma.masked_values(data, nodata, copy=False)
@@ -143,10 +285,57 @@ def get_resolution_in_meters(bounds, dims):
     return get_resolution(bounds, dims)
 
 
-def get_source(path):
-    """Cached source opening."""
-    with rasterio.Env():
-        return rasterio.open(path)
+def get_source(path, overview_level=None, **options):
+    """Cached source opening.
+
+    Returns a context manager that checks out an open dataset for path (opened
+    within a GDAL environment configured using options) from `SOURCE_CACHE` and
+    returns it to the cache on exit. When overview_level is provided, the
+    corresponding overview is opened as though it were a full-resolution
+    dataset.
+    """
+    open_options = None
+    if overview_level is not None:
+        open_options = {"OVERVIEW_LEVEL": overview_level}
+
+    return SOURCE_CACHE.open(path, open_options=open_options, **options)
+
+
+def get_overview_level(src, bounds, target_shape):
+    """Choose the coarsest overview of src that's at least as fine as the
+    target resolution.
+
+    Returns:
+        int -- Overview level (0 is the first overview), or None if the
+            full-resolution data should be read.
+    """
+    factors = src.overviews(1)
+
+    if not factors or src.crs is None:
+        return None
+
+    if bounds.crs == src.crs:
+        target_bounds = bounds.bounds
+    else:
+        target_bounds = warp.transform_bounds(bounds.crs, src.crs, *bounds.bounds)
+
+    height, width = target_shape
+    target_resolution = (
+        abs(target_bounds[2] - target_bounds[0]) / width,
+        abs(target_bounds[3] - target_bounds[1]) / height,
+    )
+    source_resolution = src.res
+
+    level = None
+    for i, factor in enumerate(factors):
+        # allow for floating point error
+        if all(
+            source_resolution[n] * factor <= target_resolution[n] * 1.0001
+            for n in (0, 1)
+        ):
+            level = i
+
+    return level
 
 
 def get_zoom(resolution, op=round):
@@ -155,11 +344,106 @@ def get_zoom(resolution, op=round):
     )
 
 
-def read_window(src, bounds, target_shape, source):
+def _geometry_mask(source, bounds, target_shape):
+    """Rasterize a source's mask (if any), producing a boolean mask."""
+    mask = get_mask(source, bounds.crs)
+
+    if mask is None:
+        return np.ma.nomask
+
+    return mask.rasterize(bounds.bounds, target_shape)
+
+
+def _aligned_window(src, bounds, target_shape, tolerance=1e-6):
+    """Determine the window of src corresponding to bounds if src's pixel grid
+    matches the target's and the window is entirely within src.
+
+    Returns:
+        Window -- Source window, or None if the grids don't match.
+    """
+    if src.crs != bounds.crs:
+        return None
+
+    height, width = target_shape
+    src_transform = src.transform
+    dst_transform = from_bounds(*bounds.bounds, width=width, height=height)
+
+    if (
+        src_transform.b != 0
+        or src_transform.d != 0
+        or abs(src_transform.a - dst_transform.a) > tolerance * abs(dst_transform.a)
+        or abs(src_transform.e - dst_transform.e) > tolerance * abs(dst_transform.e)
+    ):
+        # rotated or at a different resolution
+        return None
+
+    col_off = (dst_transform.c - src_transform.c) / src_transform.a
+    row_off = (dst_transform.f - src_transform.f) / src_transform.e
+
+    if abs(col_off - round(col_off)) > tolerance or abs(
+        row_off - round(row_off)
+    ) > tolerance:
+        # same resolution but shifted by a fraction of a pixel
+        return None
+
+    window = windows.Window(int(round(col_off)), int(round(row_off)), width, height)
+
+    if (
+        window.col_off < 0
+        or window.row_off < 0
+        or window.col_off + width > src.width
+        or window.row_off + height > src.height
+    ):
+        # boundless reads are implemented using a VRT anyway
+        return None
+
+    return window
+
+
+def _read_aligned(src, window, bounds, target_shape, source):
+    """Read (and mask) a window from a source without warping it."""
+    indexes = [
+        i
+        for (i, ci) in enumerate(src.colorinterp, start=1)
+        if ci != ColorInterp.alpha
+    ]
+
+    data = src.read(indexes, window=window)
+
+    src_nodata = source.recipes.get("nodata", source.meta.get("nodata", src.nodata))
+
+    if (
+        any([MaskFlags.per_dataset in flags for flags in src.mask_flag_enums])
+        and not any([MaskFlags.alpha in flags for flags in src.mask_flag_enums])
+    ):
+        # prefer the mask if available (as read_window does)
+        src_nodata = src.nodata
+
+    if src_nodata is not None and src_nodata != src.nodata:
+        # mask using the provided NODATA value rather than the source's
+        invalid = np.ma.getmaskarray(_mask(data, src_nodata))
+    else:
+        # 0 = invalid (covers NODATA, per-dataset masks, and alpha bands)
+        invalid = src.read_masks(indexes, window=window) == 0
+
+    # like the warper, only treat pixels as invalid when all bands are
+    mask = np.logical_or(
+        invalid.all(axis=0), _geometry_mask(source, bounds, target_shape)
+    )
+
+    return np.ma.masked_array(data, mask=np.broadcast_to(mask, data.shape).copy())
+
+
+def _warp_plan(src, target_crs, target_resolution, source):
+    """Determine how to warp src into target_crs at target_resolution.
+
+    Returns:
+        WarpPlan -- Destination resolution, resampling method, NODATA value
+            and whether to add an alpha band.
+    """
     source_resolution = get_resolution_in_meters(
         Bounds(src.bounds, src.crs), (src.height, src.width)
     )
-    target_resolution = get_resolution(bounds, target_shape)
 
     # GDAL chooses target extents such that reprojected pixels are square; this
     # may produce pixel offsets near the edges of projected bounds
@@ -173,7 +457,7 @@ def read_window(src, bounds, target_shape, source):
 
     if (
         "dem" in source.recipes
-        and bounds.crs == WEB_MERCATOR_CRS
+        and target_crs == WEB_MERCATOR_CRS
         and (
             target_resolution[0] > source_resolution[0]
             and target_resolution[1] > source_resolution[1]
@@ -184,18 +468,11 @@ def read_window(src, bounds, target_shape, source):
         # (and is a power of 2)
         zoom = min(
             22,  # going beyond this results in overflow within GDAL
-            get_zoom(
-                max(
-                    get_resolution_in_meters(
-                        Bounds(src.bounds, src.crs), (src.height, src.width)
-                    )
-                ),
-                op=math.ceil,
-            ),
+            get_zoom(max(source_resolution), op=math.ceil),
         )
 
         dst_width = dst_height = (2 ** zoom) * 256
-        extent = get_extent(bounds.crs)
+        extent = get_extent(target_crs)
         resolution = (
             (extent[2] - extent[0]) / dst_width, (extent[3] - extent[1]) / dst_height
         )
@@ -215,7 +492,7 @@ def read_window(src, bounds, target_shape, source):
 
         (dst_transform, dst_width, dst_height) = warp.calculate_default_transform(
             src.crs,
-            bounds.crs,
+            target_crs,
             src.width,
             src.height,
             *src.bounds,
@@ -256,40 +533,90 @@ def read_window(src, bounds, target_shape, source):
     ):
         add_alpha = False
 
+    return WarpPlan(
+        (dst_transform.a, dst_transform.e), resampling, src_nodata, add_alpha
+    )
+
+
+def get_warp_plan(src, bounds, target_shape, source):
+    """Get a (cached) warp plan for reading a source into a target.
+
+    Plans only depend on the source, the target CRS and the target resolution,
+    so they're shared by all tiles at a given zoom.
+    """
+    target_resolution = get_resolution(bounds, target_shape)
+    key = (
+        src.name,
+        src.width,
+        src.height,
+        tuple(src.transform),
+        src.crs.to_string(),
+        bounds.crs.to_string(),
+        tuple(float("{:.9g}".format(r)) for r in target_resolution),
+        "dem" in source.recipes,
+        source.recipes.get("resample"),
+        source.recipes.get("nodata"),
+        source.meta.get("nodata"),
+    )
+
+    plan = WARP_PLAN_CACHE.get(key)
+
+    if plan is None:
+        plan = _warp_plan(src, bounds.crs, target_resolution, source)
+        WARP_PLAN_CACHE.set(key, plan)
+
+    return plan
+
+
+def read_window(src, bounds, target_shape, source, timings=None):
+    """Read (reprojecting and resampling as necessary) a window covering bounds
+    from src.
+
+    When timings is a dict, the time taken to build a WarpedVRT (if one was
+    needed) is stored in it as vrt_seconds.
+    """
+    window = _aligned_window(src, bounds, target_shape)
+
+    if window is not None:
+        # the source's pixel grid matches the target's; no need to reproject
+        # or resample, so read from it directly
+        return PixelCollection(
+            _read_aligned(src, window, bounds, target_shape, source), bounds
+        )
+
+    plan = get_warp_plan(src, bounds, target_shape, source)
+    dst_resolution, resampling, src_nodata, add_alpha = plan
+
     w, s, e, n = bounds.bounds
     vrt_transform = (
         Affine.translation(w, n)
-        * Affine.scale(dst_transform.a, dst_transform.e)
+        * Affine.scale(*dst_resolution)
         * Affine.identity()
     )
-    vrt_width = math.floor((e - w) / dst_transform.a)
-    vrt_height = math.floor((s - n) / dst_transform.e)
-
-    with WarpedVRT(
-        src,
-        src_nodata=src_nodata,
-        crs=bounds.crs,
-        width=vrt_width,
-        height=vrt_height,
-        transform=vrt_transform,
-        resampling=resampling,
-        add_alpha=add_alpha,
-    ) as vrt:
+    vrt_width = math.floor((e - w) / dst_resolution[0])
+    vrt_height = math.floor((s - n) / dst_resolution[1])
+
+    with Timer() as t:
+        vrt = WarpedVRT(
+            src,
+            src_nodata=src_nodata,
+            crs=bounds.crs,
+            width=vrt_width,
+            height=vrt_height,
+            transform=vrt_transform,
+            resampling=resampling,
+            add_alpha=add_alpha,
+        )
+
+    if timings is not None:
+        timings["vrt_seconds"] = t.elapsed
+
+    with vrt:
         dst_window = vrt.window(*bounds.bounds)
 
         data = vrt.read(out_shape=(vrt.count,) + target_shape, window=dst_window)
 
-        mask = np.ma.nomask
-        if source.mask:
-            with rasterio.Env(OGR_ENABLE_PARTIAL_REPROJECTION=True):
-                geom_mask = transform_geom(WGS84_CRS, bounds.crs, source.mask)
-
-            mask_transform = from_bounds(
-                *bounds.bounds, height=target_shape[0], width=target_shape[1]
-            )
-            mask = geometry_mask(
-                [geom_mask], target_shape, transform=mask_transform, invert=True
-            )
+        mask = _geometry_mask(source, bounds, target_shape)
 
         if any([ColorInterp.alpha in vrt.colorinterp]):
             alpha_idx = vrt.colorinterp.index(ColorInterp.alpha)
@@ -309,19 +636,52 @@ def read_window(src, bounds, target_shape, source):
     return PixelCollection(data, bounds)
 
 
-def render(
+def _reserve(bounds, shape, transformation=None, deadline=None):
+    """Reserve memory for rendering bounds into shape from the process-wide
+    budget (see budget.py) for the duration of a with block."""
+    return BUDGET.reserve(_estimate(bounds, shape, transformation), deadline=deadline)
+
+
+def _estimate(bounds, shape, transformation=None):
+    if transformation:
+        _, shape, _ = transformation.expand(bounds, shape)
+
+    # the canvas, windows being read ahead, the window being pasted, and
+    # transformed and formatted output
+    return estimate(shape, buffers=(mosaic.READ_LOOKAHEAD or 4) + 4)
+
+
+def _get_sources(catalog, bounds, resolution, deadline=None):
+    """Get sources from a catalog, passing a time-bounded deadline along."""
+    if deadline is not None:
+        deadline.check("Getting sources")
+
+    if deadline is None or deadline.expires_at is None:
+        return catalog.get_sources(bounds, resolution)
+
+    return catalog.get_sources(bounds, resolution, deadline=deadline)
+
+
+def _render(
     bounds,
     shape,
     target_crs,
-    format,
     expand,
     catalog=None,
     sources=None,
     transformation=None,
+    deadline=None,
 ):
     """Render data intersecting bounds into shape using an optional
-    transformation."""
+    transformation, stopping short of formatting it.
+
+    Returns:
+        (PixelCollection, str, list, list, list) -- Tuple of pixels, data
+            format, sources used, stage timings, and (type, description)
+            details about the render.
+    """
     resolution_m = get_resolution_in_meters(bounds, shape)
+    offsets = None
     stats = []
 
     if sources is None and catalog is None:
@@ -332,27 +692,86 @@ def render(
 
     if sources is None and catalog is not None:
         with Timer() as t:
-            sources = catalog.get_sources(bounds, resolution_m)
+            # catalogs may return generators; fetch sources while timing this
+            sources = list(
+                _get_sources(catalog, bounds, resolution_m, deadline=deadline) or []
+            )
         stats.append(("Get Sources", t.elapsed))
 
-    # clone sources to prevent materializing the iterator
-    sources, s = itertools.tee(sources or [])
+    return _render_sources(
+        bounds,
+        shape,
+        target_crs,
+        expand,
+        sources,
+        transformation=transformation,
+        offsets=offsets,
+        stats=stats,
+        deadline=deadline,
+    )
+
+
+def _render_sources(
+    bounds,
+    shape,
+    target_crs,
+    expand,
+    sources,
+    transformation=None,
+    offsets=None,
+    stats=None,
+    deadline=None,
+):
+    """Render data from sources (within bounds and shape, already expanded by
+    the transformation, if any); the remainder of _render."""
+    stats = stats if stats is not None else []
 
-    try:
-        # attempt to fetch the next tee'd source
-        next(s)
-    except StopIteration:
+    if deadline is not None:
+        deadline.check("Planning")
+
+    with Timer() as t:
+        sources, sources_skipped = mosaic.plan(sources or [], bounds, shape)
+    stats.append(("Plan", t.elapsed))
+
+    details = [
+        ("skip", "{} - {}".format(_escape(s.name), s.url)) for s in sources_skipped
+    ]
+
+    if not sources:
         raise NoDataAvailable()
 
+    reads = []
     with Timer() as t:
-        sources_used, pixels = mosaic.composite(
-            sources, bounds, shape, target_crs, expand
-        )
+        try:
+            sources_used, pixels = mosaic.composite(
+                sources,
+                bounds,
+                shape,
+                target_crs,
+                expand,
+                stats=reads,
+                deadline=deadline,
+            )
+        except (CPLE_OutOfMemoryError, MemoryError) as e:
+            raise InsufficientMemory("Compositing failed: {}".format(e))
     stats.append(("Composite", t.elapsed))
 
+    details.extend(
+        ("ovr", "{} - {}".format(_escape(source.name), info["overview"]))
+        for (source, info) in reads
+        if info.get("overview") is not None
+    )
+
     if pixels is None or pixels.data is None:
         raise NoDataAvailable()
 
+    if deadline is not None:
+        if deadline.truncated:
+            # partial results have already run out of time; finish them anyway
+            details.append(("partial", "Deadline exceeded"))
+        else:
+            deadline.check("Transforming")
+
     data_format = "raw"
 
     if transformation:
@@ -365,28 +784,144 @@ def render(
 
         stats.append(("Post-process", t.elapsed))
 
-    with Timer() as t:
-        (content_type, formatted) = format(pixels, data_format, sources_used)
-    stats.append(("Format", t.elapsed))
+    return pixels, data_format, sources_used, stats, details
+
 
-    headers = {
+def _headers(content_type, stats, sources_used, details):
+    counts = {}
+
+    def _index(key):
+        counts[key] = counts.get(key, -1) + 1
+        return counts[key]
+
+    return {
         "Content-Type": content_type,
         "Server-Timing": [
             'op{};desc="{}";dur={:0.2f}'.format(i, name, time * 1000)
             for (i, (name, time)) in enumerate(stats)
         ]
         + [
-            'src{};desc="{} - {}"'.format(
-                i,
-                unicodedata.normalize("NFKD", str(name)).replace('"', '\\"').encode(
-                    "ascii", "ignore"
-                ).decode(
-                    "ascii"
-                ),
-                url,
-            )
+            'src{};desc="{} - {}"'.format(i, _escape(name), url)
             for (i, (name, url)) in enumerate(sources_used)
+        ]
+        + [
+            '{}{};desc="{}"'.format(key, _index(key), desc)
+            for (key, desc) in details
         ],
     }
 
-    return (headers, formatted)
+
+def render(
+    bounds,
+    shape,
+    target_crs,
+    format,
+    expand,
+    catalog=None,
+    sources=None,
+    transformation=None,
+    deadline=None,
+):
+    """Render data intersecting bounds into shape using an optional
+    transformation.
+
+    When a deadline (deadline.Deadline) is provided, it's checked between
+    stages and source reads; DeadlineExceeded (or RenderCancelled) is raised
+    if it passes (or is cancelled) unless it allows partial results.
+
+    Renders wait for memory to be available within the process-wide budget
+    (see budget.py) before starting; InsufficientMemory is raised if it isn't
+    available in time.
+    """
+    with _reserve(bounds, shape, transformation, deadline=deadline):
+        pixels, data_format, sources_used, stats, details = _render(
+            bounds,
+            shape,
+            target_crs,
+            expand,
+            catalog=catalog,
+            sources=sources,
+            transformation=transformation,
+            deadline=deadline,
+        )
+
+        if deadline is not None and not deadline.truncated:
+            deadline.check("Formatting")
+
+        with Timer() as t:
+            (content_type, formatted) = _format(
+                format, pixels, data_format, sources_used
+            )
+        stats.append(("Format", t.elapsed))
+
+    METRICS.stages(stats)
+
+    return (_headers(content_type, stats, sources_used, details), formatted)
+
+
+def render_blocks(
+    bounds,
+    shape,
+    target_crs,
+    expand,
+    catalog=None,
+    sources=None,
+    transformation=None,
+    blocksize=1024,
+    deadline=None,
+):
+    """Render data intersecting bounds into shape one block at a time, so
+    that the whole canvas is never held in memory at once.
+
+    Each block is rendered independently (sources are looked up per block when
+    a catalog is provided); blocks without data are skipped.
+
+    Keyword Arguments:
+        blocksize {int} -- Width / height of blocks (in pixels).
+            (default: {1024})
+
+    Yields:
+        (rasterio.windows.Window, PixelCollection, str, list, list, list) --
+            Tuples of the window within shape covered by the block, followed
+            by the block's pixels, data format, sources used, stage timings
+            and details (see _render).
+    """
+    if sources is None and catalog is None:
+        raise Exception("Either sources or a catalog must be provided.")
+
+    if sources is not None:
+        # sources are re-used for each block
+        sources = list(sources)
+
+    (height, width) = shape
+    affine = from_bounds(*bounds.bounds, width=width, height=height)
+
+    for row_off in range(0, height, blocksize):
+        for col_off in range(0, width, blocksize):
+            window = windows.Window(
+                col_off,
+                row_off,
+                min(blocksize, width - col_off),
+                min(blocksize, height - row_off),
+            )
+            block_bounds = Bounds(windows.bounds(window, affine), bounds.crs)
+            block_shape = (window.height, window.width)
+
+            # hold the reservation while the block is being consumed
+            with _reserve(block_bounds, block_shape, transformation, deadline):
+                try:
+                    rendered = _render(
+                        block_bounds,
+                        block_shape,
+                        target_crs,
+                        expand,
+                        catalog=catalog,
+                        sources=sources,
+                        transformation=transformation,
+                        deadline=deadline,
+                    )
+                except NoDataAvailable:
+                    LOG.debug("No data available for %s", window)
+                    continue
+
+                yield (window,) + rendered
@@ -0,0 +1,211 @@
+# coding=utf-8
+"""asyncio variants of render and render_tile (Python 3.5+).
+
+Blocking stages (catalog lookups, compositing and formatting) run on a bounded
+thread pool rather than on the event loop; composite dispatches raster reads to
+the shared read pool as usual. When an awaiting task is cancelled (e.g. because
+a client disconnected), the render is told to stop and reads that haven't
+started are abandoned.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import logging
+import multiprocessing
+import os
+
+import mercantile
+from affine import Affine
+
+from . import (
+    _estimate,
+    _format,
+    _get_sources,
+    _headers,
+    _render_sources,
+    get_resolution_in_meters,
+)
+from .budget import BUDGET
+from .deadline import Deadline
+from .pool import ReadPool
+from .stats import METRICS, Timer
+from .tiling import (
+    TILE_SHAPE,
+    WEB_MERCATOR_CRS,
+    _from_cache,
+    _to_cache,
+    tile_cache_key,
+)
+from .utils import Bounds
+
+LOG = logging.getLogger(__name__)
+RENDER_POOL = ReadPool(
+    int(os.getenv("MARBLECUTTER_ASYNC_POOL_SIZE", multiprocessing.cpu_count() * 2)),
+    name="async_pool",
+)
+
+
+async def _run(fn, *args, **kwargs):
+    """Run a blocking function on the render pool."""
+    return await asyncio.wrap_future(RENDER_POOL.submit(fn, *args, **kwargs))
+
+
+async def get_sources(catalog, bounds, resolution, deadline=None):
+    """Get sources from a catalog without blocking the event loop.
+
+    Catalogs providing a `get_sources_async` coroutine are awaited directly;
+    others are queried on the render pool.
+    """
+    get_sources_async = getattr(catalog, "get_sources_async", None)
+
+    if get_sources_async is not None:
+        if deadline is not None:
+            deadline.check("Getting sources")
+
+        if deadline is None or deadline.expires_at is None:
+            return await get_sources_async(bounds, resolution)
+
+        return await get_sources_async(bounds, resolution, deadline=deadline)
+
+    # catalogs may return generators that query lazily
+    return await _run(
+        lambda: list(_get_sources(catalog, bounds, resolution, deadline=deadline))
+    )
+
+
+def _render_and_format(
+    bounds, shape, target_crs, format, expand, sources, deadline, **kwargs
+):
+    """Render (see _render_sources) and format, holding a reservation from the
+    memory budget while doing so."""
+    with BUDGET.reserve(_estimate(bounds, shape), deadline=deadline):
+        pixels, data_format, sources_used, stats, details = _render_sources(
+            bounds, shape, target_crs, expand, sources, deadline=deadline, **kwargs
+        )
+
+        if not deadline.truncated:
+            deadline.check("Formatting")
+
+        with Timer() as t:
+            (content_type, formatted) = _format(
+                format, pixels, data_format, sources_used
+            )
+        stats.append(("Format", t.elapsed))
+
+    return content_type, formatted, sources_used, stats, details
+
+
+async def render(
+    bounds,
+    shape,
+    target_crs,
+    format,
+    expand,
+    catalog=None,
+    sources=None,
+    transformation=None,
+    deadline=None,
+):
+    """Render data intersecting bounds into shape using an optional
+    transformation (see marblecutter.render)."""
+    deadline = deadline or Deadline()
+    resolution_m = get_resolution_in_meters(bounds, shape)
+    offsets = None
+    stats = []
+
+    if sources is None and catalog is None:
+        raise Exception("Either sources or a catalog must be provided.")
+
+    if transformation:
+        bounds, shape, offsets = transformation.expand(bounds, shape)
+
+    try:
+        if sources is None:
+            with Timer() as t:
+                sources = await get_sources(
+                    catalog, bounds, resolution_m, deadline=deadline
+                )
+            stats.append(("Get Sources", t.elapsed))
+
+        content_type, formatted, sources_used, stats, details = await _run(
+            _render_and_format,
+            bounds,
+            shape,
+            target_crs,
+            format,
+            expand,
+            sources,
+            deadline,
+            transformation=transformation,
+            offsets=offsets,
+            stats=stats,
+        )
+    except asyncio.CancelledError:
+        # stop waiting for memory or compositing (if it's still running)
+        deadline.cancel()
+        raise
+
+    METRICS.stages(stats)
+
+    return (_headers(content_type, stats, sources_used, details), formatted)
+
+
+async def render_tile(
+    tile,
+    catalog,
+    transformation=None,
+    format=None,
+    scale=1,
+    expand=True,
+    cache=None,
+    deadline=None,
+):
+    """Render a tile into Web Mercator (see tiling.render_tile).
+
+    Returns:
+        (dict, bytes) -- Tuple of HTTP headers (dict) and bytes.
+    """
+    bounds = Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS)
+    shape = tuple(map(int, Affine.scale(scale) * TILE_SHAPE))
+
+    catalog.validate(tile)
+
+    if cache is None:
+        return await render(
+            bounds,
+            shape,
+            WEB_MERCATOR_CRS,
+            catalog=catalog,
+            format=format,
+            transformation=transformation,
+            expand=expand,
+            deadline=deadline,
+        )
+
+    with Timer() as t:
+        key = tile_cache_key(tile, catalog, transformation, format, scale, expand)
+        cached = await _run(cache.get, key)
+
+    METRICS.increment(
+        "tile_cache.lookups", result="miss" if cached is None else "hit"
+    )
+
+    if cached is not None:
+        return _from_cache(key, cached, t.elapsed)
+
+    headers, data = await render(
+        bounds,
+        shape,
+        WEB_MERCATOR_CRS,
+        catalog=catalog,
+        format=format,
+        transformation=transformation,
+        expand=expand,
+        deadline=deadline,
+    )
+
+    if deadline is not None and deadline.truncated:
+        # don't cache partial results
+        return headers, data
+
+    return await _run(_to_cache, cache, key, headers, data)
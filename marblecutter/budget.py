@@ -0,0 +1,184 @@
+# coding=utf-8
+"""Process-wide budget for memory used by in-flight renders.
+
+Renders reserve an estimate of the memory that their pixel buffers (canvases,
+source windows read ahead of compositing, masks, transformed and formatted
+output) will need before starting and release it when they finish. When a
+reservation doesn't fit, the render waits for others to finish; if that takes
+too long, it's rejected with InsufficientMemory (which the Flask blueprint
+turns into a 503).
+"""
+from __future__ import absolute_import, division
+
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from .stats import METRICS, clock
+
+LOG = logging.getLogger(__name__)
+
+# interval at which waiting reservations check whether they've been cancelled
+POLL_INTERVAL = 0.1
+
+
+def estimate(shape, bands=4, itemsize=4, buffers=6):
+    """Estimate the memory needed to render shape.
+
+    The number of bands and their data type aren't known until sources have
+    been read, so this assumes normalized (float32) RGBA.
+
+    Arguments:
+        shape {tuple} -- Shape (height, width) to render.
+
+    Keyword Arguments:
+        bands {int} -- Number of bands. (default: {4})
+        itemsize {int} -- Bytes per sample. (default: {4})
+        buffers {int} -- Number of buffers (each with a mask) held at once.
+            (default: {6})
+
+    Returns:
+        int -- Bytes.
+    """
+    (height, width) = shape
+
+    # data + mask
+    return height * width * bands * (itemsize + 1) * buffers
+
+
+class MemoryBudget(object):
+    """Limits the (estimated) memory used by concurrent renders.
+
+    Keyword Arguments:
+        limit {int} -- Bytes available to renders; None for no limit (usage is
+            still tracked). (default: {None})
+        timeout {float} -- Seconds to wait for a reservation before rejecting
+            it; None to wait indefinitely. (default: {None})
+    """
+
+    def __init__(self, limit=None, timeout=None):
+        self.limit = limit
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._used = 0
+        self._peak = 0
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    def _update(self):
+        METRICS.gauge("memory_budget.used_bytes", self._used)
+        METRICS.gauge("memory_budget.active_renders", self._active)
+
+    def acquire(self, nbytes, deadline=None):
+        """Reserve nbytes, waiting for other renders to release theirs if
+        necessary.
+
+        Reservations larger than the limit are reduced to the limit (so they
+        run once nothing else is).
+
+        Arguments:
+            nbytes {int} -- Bytes to reserve.
+
+        Keyword Arguments:
+            deadline {deadline.Deadline} -- Deadline / cancellation token
+                bounding the wait. (default: {None})
+
+        Returns:
+            int -- Bytes reserved (to be passed to release()).
+        """
+        # avoid circular dependencies
+        from . import InsufficientMemory
+
+        if self.limit is not None:
+            nbytes = min(nbytes, self.limit)
+
+        start = clock()
+
+        with self._cond:
+            while self.limit is not None and self._used + nbytes > self.limit:
+                if deadline is not None:
+                    deadline.check("Waiting for memory")
+
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (clock() - start)
+                if deadline is not None and deadline.expires_at is not None:
+                    left = deadline.remaining()
+                    remaining = left if remaining is None else min(remaining, left)
+
+                if remaining is not None and remaining <= 0:
+                    if deadline is not None:
+                        # raise DeadlineExceeded if that's what ran out
+                        deadline.check("Waiting for memory")
+
+                    self._rejected += 1
+                    METRICS.increment("memory_budget.rejections")
+
+                    raise InsufficientMemory(
+                        "Unable to reserve {} bytes ({} of {} in use)".format(
+                            nbytes, self._used, self.limit
+                        )
+                    )
+
+                if deadline is not None:
+                    # wake up periodically to notice cancellation
+                    remaining = min(remaining or POLL_INTERVAL, POLL_INTERVAL)
+
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            self._used += nbytes
+            self._peak = max(self._peak, self._used)
+            self._active += 1
+            self._admitted += 1
+            self._update()
+
+        METRICS.timing("memory_budget.wait_seconds", clock() - start)
+        METRICS.size("memory_budget.reserved_bytes", nbytes)
+
+        return nbytes
+
+    def release(self, nbytes):
+        """Release a reservation."""
+        with self._cond:
+            self._used -= nbytes
+            self._active -= 1
+            self._update()
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes, deadline=None):
+        """Hold a reservation for the duration of a with block (see
+        acquire())."""
+        reserved = self.acquire(nbytes, deadline=deadline)
+
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "used": self._used,
+                "peak": self._peak,
+                "active": self._active,
+                "waiting": self._waiting,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+            }
+
+
+BUDGET = MemoryBudget(
+    limit=int(float(os.getenv("MARBLECUTTER_MEMORY_BUDGET_MB", 0)) * 1024 * 1024)
+    or None,
+    timeout=float(os.getenv("MARBLECUTTER_MEMORY_BUDGET_TIMEOUT", 10)),
+)
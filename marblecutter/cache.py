@@ -0,0 +1,560 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+import rasterio
+
+LOG = logging.getLogger(__name__)
+
+
+class DatasetCache(object):
+    """Bounded, thread-safe pool of open datasets.
+
+    Handles are keyed by path and the GDAL environment options they were opened
+    with. A handle is only ever checked out to one thread at a time (GDAL
+    datasets are not safe for concurrent use), so a key may have multiple open
+    handles when it's being read concurrently.
+
+    Idle handles are evicted in LRU order once more than `max_open` handles are
+    open, and are re-opened after `ttl` seconds so that changes to remote
+    sources are eventually noticed. Handles that are checked out when they are
+    evicted or invalidated are closed when they're released.
+    """
+
+    def __init__(self, max_open=64, ttl=300):
+        self.max_open = max_open
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        # key -> [(dataset, opened_at)], ordered from least to most recently used
+        self._idle = OrderedDict()
+        # id(dataset) -> (key, opened_at, generation)
+        self._in_use = {}
+        self._open = 0
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(path, open_options, options):
+        return (
+            path,
+            tuple(sorted((open_options or {}).items())),
+            tuple(sorted(options.items())),
+        )
+
+    def _expired(self, opened_at, now):
+        return self.ttl is not None and now - opened_at > self.ttl
+
+    def _evict_idle(self, now):
+        """Remove expired idle handles and any beyond the limit (oldest first).
+
+        Must be called with the lock held; returns datasets to close.
+        """
+        evicted = []
+
+        for key in list(self._idle.keys()):
+            handles = self._idle[key]
+            fresh = [(ds, t) for (ds, t) in handles if not self._expired(t, now)]
+            evicted.extend(ds for (ds, t) in handles if self._expired(t, now))
+
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+        while self._open - len(evicted) > self.max_open and self._idle:
+            key, handles = next(iter(self._idle.items()))
+            ds, _ = handles.pop(0)
+            evicted.append(ds)
+
+            if not handles:
+                del self._idle[key]
+
+        self._open -= len(evicted)
+        self.evictions += len(evicted)
+
+        return evicted
+
+    @staticmethod
+    def _close(datasets):
+        for ds in datasets:
+            try:
+                ds.close()
+            except Exception as e:
+                LOG.warning("Error closing %s: %s", ds.name, e)
+
+    def acquire(self, path, open_options=None, **options):
+        """Check out an open dataset for path, opening it if necessary.
+
+        open_options are passed to the driver when opening the dataset; other
+        options configure the GDAL environment it's opened within.
+        """
+        key = self._key(path, open_options, options)
+        now = time.time()
+
+        with self._lock:
+            evicted = self._evict_idle(now)
+            handles = self._idle.get(key)
+
+            if handles:
+                ds, opened_at = handles.pop()
+
+                if handles:
+                    # mark as most recently used
+                    self._idle[key] = self._idle.pop(key)
+                else:
+                    del self._idle[key]
+
+                self._in_use[id(ds)] = (key, opened_at, self._generation)
+                self.hits += 1
+            else:
+                ds = None
+                self.misses += 1
+                # reserve a slot for the handle we're about to open
+                self._open += 1
+                generation = self._generation
+
+        self._close(evicted)
+
+        if ds is not None:
+            return ds
+
+        try:
+            with rasterio.Env(**options):
+                ds = rasterio.open(path, **(open_options or {}))
+        except Exception:
+            with self._lock:
+                self._open -= 1
+            raise
+
+        with self._lock:
+            self._in_use[id(ds)] = (key, now, generation)
+
+        return ds
+
+    def release(self, ds):
+        """Return a checked-out dataset to the pool."""
+        now = time.time()
+        close = False
+
+        with self._lock:
+            key, opened_at, generation = self._in_use.pop(id(ds))
+
+            if (
+                ds.closed
+                or generation != self._generation
+                or self._expired(opened_at, now)
+                or self._open > self.max_open
+            ):
+                self._open -= 1
+                close = True
+            else:
+                handles = self._idle.pop(key, [])
+                handles.append((ds, opened_at))
+                self._idle[key] = handles
+
+        if close:
+            self._close([ds])
+
+    @contextmanager
+    def open(self, path, open_options=None, **options):
+        ds = self.acquire(path, open_options=open_options, **options)
+
+        try:
+            yield ds
+        finally:
+            self.release(ds)
+
+    def clear(self):
+        """Close all idle handles; checked-out handles are closed on release."""
+        with self._lock:
+            evicted = [ds for handles in self._idle.values() for (ds, _) in handles]
+            self._idle.clear()
+            self._open -= len(evicted)
+            self.evictions += len(evicted)
+            self._generation += 1
+
+        self._close(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "open": self._open,
+                "idle": sum(len(handles) for handles in self._idle.values()),
+                "in_use": len(self._in_use),
+            }
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache bounded by the total size of its values.
+
+    Keyword Arguments:
+        max_size {int} -- Maximum total size of cached values. (default: {1024})
+        ttl {float} -- Seconds after which entries expire. (default: {None})
+        sizeof {function} -- Function returning the size of a value; values
+            count as 1 by default. (default: {None})
+    """
+
+    def __init__(self, max_size=1024, ttl=None, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+
+        self._lock = threading.Lock()
+        # key -> (value, size, expires_at), ordered from least to most recently
+        # used
+        self._entries = OrderedDict()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, size, expires_at = entry
+
+            if expires_at is not None and expires_at < time.time():
+                self._size -= size
+                self.misses += 1
+                return default
+
+            # mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+
+        if size > self.max_size:
+            # never going to fit
+            return
+
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time.time() + self.ttl
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (value, size, expires_at)
+            self._size += size
+
+            while self._size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_matching(self, predicate):
+        """Remove entries whose keys match predicate."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size": self._size,
+            }
+
+
+def _describe(obj, seen=None):
+    """Produce a JSON-serializable, deterministic description of obj.
+
+    seen holds the ids of the objects being described (obj's ancestors), so
+    that self-referencing objects are described without recursing forever.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    if isinstance(obj, bytes):
+        return hashlib.sha1(obj).hexdigest()
+
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return "<cycle>"
+
+    seen.add(id(obj))
+    try:
+        return _describe_object(obj, seen)
+    finally:
+        seen.discard(id(obj))
+
+
+def _describe_object(obj, seen):
+    if hasattr(obj, "cache_key"):
+        return _describe(obj.cache_key, seen)
+
+    if isinstance(obj, np.ndarray):
+        return [
+            str(obj.dtype),
+            list(obj.shape),
+            hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest(),
+            _describe(np.ma.getmask(obj), seen) if np.ma.is_masked(obj) else None,
+        ]
+
+    if isinstance(obj, dict):
+        return sorted([str(k), _describe(v, seen)] for k, v in obj.items())
+
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return [_describe(x, seen) for x in obj]
+
+    name = "{}.{}".format(
+        getattr(obj, "__module__", None),
+        getattr(obj, "__qualname__", getattr(obj, "__name__", type(obj).__name__)),
+    )
+
+    if callable(obj) and hasattr(obj, "__code__"):
+        # functions (e.g. formats) are identified by their name and any
+        # values they close over
+        return [
+            name,
+            [_describe(cell.cell_contents, seen) for cell in obj.__closure__ or []],
+        ]
+
+    # other objects are identified by their class and public attributes
+    return [
+        "{}.{}".format(type(obj).__module__, type(obj).__name__),
+        _describe(
+            dict(
+                (k, v)
+                for k, v in getattr(obj, "__dict__", {}).items()
+                if not k.startswith("_")
+            ),
+            seen,
+        ),
+    ]
+
+
+def fingerprint(*args):
+    """Generate a stable digest identifying args.
+
+    Objects may provide a `cache_key` attribute to control how they're
+    identified.
+    """
+    return hashlib.sha1(
+        json.dumps(_describe(args), sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class MemoryTileCache(object):
+    """In-memory tile cache bounded by the total size (in bytes) of cached
+    tiles."""
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self._cache = LRUCache(
+            max_size=max_size, sizeof=lambda entry: len(entry[1]) + 512
+        )
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, headers, data):
+        self._cache.set(key, (headers, bytes(data)))
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class FileSystemTileCache(object):
+    """On-disk tile cache bounded by the total size (in bytes) of cached tiles.
+
+    Tiles are stored under path as individual files (headers + data). When the
+    cache exceeds max_size, least-recently-used tiles are removed until it's
+    under 90% of max_size. When use_mmap is set, tile data is returned as a
+    memoryview of a memory-mapped file rather than read into memory.
+
+    Keys include catalogs' versions, which only live in memory (they start
+    over when a process does), so tiles cached before a catalog was
+    invalidated would be served again after a restart. clear() the cache when
+    invalidating catalogs whose tiles are stored in it.
+    """
+
+    _header = struct.Struct("!I")
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024, use_mmap=False):
+        self.path = path
+        self.max_size = max_size
+        self.use_mmap = use_mmap
+
+        self._lock = threading.Lock()
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for filename in self._files():
+            self._size += os.path.getsize(filename)
+
+    def _files(self):
+        for root, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith(".tile"):
+                    yield os.path.join(root, filename)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[0:2], "{}.tile".format(key))
+
+    def get(self, key):
+        filename = self._filename(key)
+
+        try:
+            with open(filename, "rb") as f:
+                (length,) = self._header.unpack(f.read(self._header.size))
+                headers = json.loads(f.read(length).decode("utf-8"))
+                offset = self._header.size + length
+
+                if self.use_mmap:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    data = memoryview(buf)[offset:]
+                else:
+                    data = f.read()
+
+            # mark as recently used
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return headers, data
+
+    def set(self, key, headers, data):
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        header = json.dumps(headers).encode("utf-8")
+
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created concurrently
+                pass
+
+        # write atomically
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._header.pack(len(header)))
+            f.write(header)
+            f.write(data)
+
+        size = os.path.getsize(tmp)
+        try:
+            previous = os.path.getsize(filename)
+        except OSError:
+            previous = 0
+
+        os.rename(tmp, filename)
+
+        with self._lock:
+            self._size += size - previous
+            evict = self._size > self.max_size
+
+        if evict:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for filename in self._files():
+            try:
+                stat = os.stat(filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+            except OSError:
+                pass
+
+        files.sort()
+        target = self.max_size * 0.9
+
+        with self._lock:
+            self._size = sum(size for (_, size, _) in files)
+
+            for (_, size, filename) in files:
+                if self._size <= target:
+                    break
+
+                try:
+                    os.remove(filename)
+                    self._size -= size
+                    self.evictions += 1
+                except OSError:
+                    pass
+
+    def clear(self):
+        """Remove all cached tiles."""
+        for filename in list(self._files()):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+        with self._lock:
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": self._size,
+            }
@@ -4,7 +4,7 @@ from __future__ import absolute_import
 import mercantile
 from rasterio.crs import CRS
 
-from .. import InvalidTileRequest
+from .. import InvalidTileRequest, _get_sources
 
 MIN_LAT = -85.05113
 MIN_LON = -180.0
@@ -24,12 +24,24 @@ class Catalog(object):
     _name = "Untitled"
     _provider = None
     _provider_url = None
+    _version = None
 
     @property
     def bounds(self):
         w, s, e, n = self._bounds
         return (max(MIN_LON, w), max(MIN_LAT, s), min(MAX_LON, e), min(MAX_LAT, n))
 
+    @property
+    def cache_key(self):
+        """Identifies this catalog (and the version of its contents) in cache
+        keys."""
+        return (
+            type(self).__name__,
+            self.id,
+            self.version,
+            dict((k, v) for k, v in vars(self).items() if not k.startswith("_")),
+        )
+
     @property
     def center(self):
         return self._center
@@ -66,9 +78,46 @@ class Catalog(object):
     def provider_url(self):
         return self._provider_url
 
-    def get_sources(self, bounds, resolution):
+    @property
+    def version(self):
+        """Version of the catalog's contents; change this to invalidate cached
+        tiles."""
+        return self._version
+
+    def get_sources(self, bounds, resolution, deadline=None):
+        """Fetch sources intersecting bounds.
+
+        Catalogs should bound any blocking I/O by deadline.remaining() (when a
+        deadline.Deadline is provided) and raise DeadlineExceeded if it runs
+        out.
+
+        Sources' masks should be complete (not clipped to bounds); reprojected
+        masks are cached by source URL.
+        """
         raise NotImplementedError
 
+    def get_sources_batch(
+        self, bounds_list, resolution, include_geometries=None, deadline=None
+    ):
+        """Fetch sources for many bounds at once.
+
+        Catalogs that can look up multiple bounds in a single round trip should
+        override this.
+
+        Keyword Arguments:
+            include_geometries {bool} -- Whether to include source footprints
+                (for catalogs that support it). (default: {None})
+            deadline {deadline.Deadline} -- Deadline / cancellation token.
+                (default: {None})
+
+        Returns:
+            list -- List of lists of sources, one per bounds.
+        """
+        return [
+            list(_get_sources(self, bounds, resolution, deadline=deadline))
+            for bounds in bounds_list
+        ]
+
     def validate(self, tile):
         if not self.minzoom <= tile.z <= self.maxzoom:
             raise InvalidTileRequest(
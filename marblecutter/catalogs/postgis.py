@@ -5,11 +5,14 @@ import json
 import logging
 import os
 
-from marblecutter import get_zoom
+import mercantile
+from marblecutter import DeadlineExceeded, get_zoom
+from psycopg2.extensions import QueryCanceledError
 from psycopg2.pool import ThreadedConnectionPool
 from rasterio import warp
 
 from . import WGS84_CRS, Catalog
+from ..cache import LRUCache
 from ..utils import Source
 
 try:
@@ -18,16 +21,77 @@ except ImportError:
     import urlparse
 
 Infinity = float("inf")
+# precision (in decimal degrees) that bounds are quantized to in cache keys
+CACHE_PRECISION = 6
+
+
+def _coordinates(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        yield coords
+    else:
+        for c in coords:
+            for coord in _coordinates(c):
+                yield coord
+
+
+def _geometry_bounds(geom):
+    xs, ys = zip(*[c[0:2] for c in _coordinates(geom["coordinates"])])
+
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _as_tile(bounds):
+    """Identify the tile with bounds (in WGS84), if there is one."""
+    left, bottom, right, top = bounds
+    epsilon = 10 ** -CACHE_PRECISION
+    tile = mercantile.bounding_tile(
+        left + epsilon, bottom + epsilon, right - epsilon, top - epsilon
+    )
+
+    if all(
+        abs(a - b) < epsilon for (a, b) in zip(mercantile.bounds(tile), bounds)
+    ):
+        return tile
 
 
 class PostGISCatalog(Catalog):
+    """Sources from a PostGIS table of footprints.
+
+    Rows' meta column is passed through as each source's metadata. Sources whose
+    metadata includes `"opaque": true` (no nodata or internal masks within
+    their footprint, less their mask) hide lower-priority sources beneath
+    them, which are then skipped rather than read (see mosaic.plan). This
+    requires footprints, i.e. include_geometries.
+    """
 
     def __init__(
         self,
         table="footprints",
         database_url=os.getenv("DATABASE_URL"),
         geometry_column="geom",
+        include_geometries=False,
+        cache_size=0,
+        cache_ttl=300,
+        reuse_parent=False,
     ):
+        """
+        Keyword Arguments:
+            include_geometries {bool} -- Whether to include source footprints by
+                default. (default: {False})
+            cache_size {int} -- Number of get_sources results to cache (0
+                disables caching). (default: {0})
+            cache_ttl {float} -- Seconds after which cached results expire.
+                (default: {300})
+            reuse_parent {bool} -- Whether to derive sources for uncached tiles
+                from their cached parent's sources (when they include
+                geometries) by filtering them by footprint and zoom. Derived
+                sources keep the order chosen for the parent, so they may
+                differ from a direct query's. (default: {False})
+        """
         if database_url is None:
             raise Exception("Database URL must be provided.")
         urlparse.uses_netloc.append("postgis")
@@ -47,9 +111,37 @@ class PostGISCatalog(Catalog):
         self._log = logging.getLogger(__name__)
         self.table = table
         self.geometry_column = geometry_column
+        # include footprints by default (allows occluded sources to be pruned
+        # before reading them)
+        self.include_geometries = include_geometries
+        self.reuse_parent = reuse_parent
+
+        self._cache = None
+        if cache_size > 0:
+            self._cache = LRUCache(max_size=cache_size, ttl=cache_ttl)
+
+    def _execute(self, cur, query, params, deadline=None):
+        """Execute a query, bounding its duration by the time remaining before
+        deadline (if any)."""
+        remaining = deadline.remaining() if deadline is not None else None
+
+        if remaining is not None:
+            # SET LOCAL only applies to the current transaction
+            cur.execute(
+                "SET LOCAL statement_timeout = %(timeout)s",
+                {"timeout": max(1, int(remaining * 1000))},
+            )
+
+        cur.execute(query, params)
 
     def _candidates(
-        self, bounds, resolution, min_zoom, max_zoom, include_geometries=False
+        self,
+        bounds,
+        resolution,
+        min_zoom,
+        max_zoom,
+        include_geometries=False,
+        deadline=None,
     ):
         self._log.info(
             "Resolution: %s; zoom range: %d-%d", resolution, min_zoom, max_zoom
@@ -72,7 +164,7 @@ class PostGISCatalog(Catalog):
                  coalesce(recipes, '{{}}'::jsonb) recipes,
                  acquired_at,
                  priority,
-                 ST_Multi(ST_Intersection(mask, bbox.geom)) mask,
+                 ST_Multi(mask) mask,
                  ST_Multi(footprints.geom) geom,
                  filename,
                  min_zoom,
@@ -121,7 +213,8 @@ class PostGISCatalog(Catalog):
         connection = self._pool.getconn()
         try:
             with connection as conn, conn.cursor() as cur:
-                cur.execute(
+                self._execute(
+                    cur,
                     query,
                     {
                         "minx": left if left != Infinity else -180,
@@ -132,6 +225,7 @@ class PostGISCatalog(Catalog):
                         "max_zoom": max_zoom,
                         "resolution": min(resolution),
                     },
+                    deadline=deadline,
                 )
 
                 for record in cur:
@@ -143,12 +237,16 @@ class PostGISCatalog(Catalog):
                         min_zoom=record[-2],
                         max_zoom=record[-1]
                     )
+        except QueryCanceledError:
+            raise DeadlineExceeded("Getting sources")
         except Exception as e:
             self._log.exception(e)
         finally:
             self._pool.putconn(connection)
 
-    def _fill_bounds(self, bounds, resolution, include_geometries=False):
+    def _fill_bounds(
+        self, bounds, resolution, include_geometries=False, deadline=None
+    ):
         zoom = get_zoom(max(resolution))
         query = """
             WITH RECURSIVE bbox AS (
@@ -177,7 +275,9 @@ class PostGISCatalog(Catalog):
                   ARRAY[coalesce(recipes, '{{}}'::jsonb)] recipes,
                   ARRAY[acquired_at] acquisition_dates,
                   ARRAY[priority] priorities,
-                  ARRAY[ST_Intersection(mask, bbox.geom)] masks,
+                  ARRAY[min_zoom] min_zooms,
+                  ARRAY[max_zoom] max_zooms,
+                  ARRAY[mask] masks,
                   ARRAY[ST_Area(ST_Intersection(bbox.geom, footprints.geom)) /
                     ST_Area(bbox.geom)] coverages,
                   ARRAY[ST_Multi(footprints.geom)] geometries,
@@ -225,6 +325,8 @@ class PostGISCatalog(Catalog):
                   sources.acquisition_dates || footprints.acquired_at
                     acquisition_dates,
                   sources.priorities || footprints.priority priorities,
+                  sources.min_zooms || footprints.min_zoom min_zooms,
+                  sources.max_zooms || footprints.max_zoom max_zooms,
                   sources.masks || footprints.mask masks,
                   sources.coverages || ST_Area(
                     ST_Intersection(
@@ -280,6 +382,8 @@ class PostGISCatalog(Catalog):
                   unnest(recipes) recipes,
                   unnest(acquisition_dates) acquired_at,
                   unnest(priorities) priority,
+                  unnest(min_zooms) min_zoom,
+                  unnest(max_zooms) max_zoom,
                   unnest(coverages) coverage,
                   unnest(masks) mask,
                   unnest(geometries) geom
@@ -303,7 +407,9 @@ class PostGISCatalog(Catalog):
               CASE WHEN ST_IsEmpty(mask)
                 THEN 'null'
                 ELSE coalesce(ST_AsGeoJSON(mask), 'null')
-              END mask
+              END mask,
+              min_zoom,
+              max_zoom
             FROM candidate_rows
         """.format(
             table=self.table,
@@ -321,7 +427,8 @@ class PostGISCatalog(Catalog):
         connection = self._pool.getconn()
         try:
             with connection as conn, conn.cursor() as cur:
-                cur.execute(
+                self._execute(
+                    cur,
                     query,
                     {
                         "minx": left if left != Infinity else -180,
@@ -331,25 +438,269 @@ class PostGISCatalog(Catalog):
                         "zoom": zoom,
                         "resolution": min(resolution),
                     },
+                    deadline=deadline,
                 )
 
                 for record in cur:
                     yield Source(
-                        *record[:-2],
-                        geom=json.loads(record[-2]),
-                        mask=json.loads(record[-1])
+                        *record[:-4],
+                        geom=json.loads(record[-4]),
+                        mask=json.loads(record[-3]),
+                        min_zoom=record[-2],
+                        max_zoom=record[-1]
                     )
+        except QueryCanceledError:
+            raise DeadlineExceeded("Getting sources")
         except Exception as e:
             self._log.exception(e)
         finally:
             self._pool.putconn(connection)
 
-    def get_sources(
-        self, bounds, resolution, min_zoom=None, max_zoom=None, include_geometries=False
+    def _fill_bounds_batch(
+        self, bounds_list, resolution, include_geometries=False, deadline=None
+    ):
+        if not bounds_list:
+            return []
+
+        zoom = get_zoom(max(resolution))
+        query = """
+            WITH RECURSIVE bbox AS (
+              SELECT
+                idx,
+                ST_MakeEnvelope(minx, miny, maxx, maxy, 4326) geom
+              FROM (VALUES {boxes}) AS boxes(idx, minx, miny, maxx, maxy)
+            ),
+            date_range AS (
+              SELECT
+                COALESCE(min(acquired_at), '1970-01-01') min,
+                COALESCE(max(acquired_at), '1970-01-01') max,
+                age(COALESCE(max(acquired_at), '1970-01-01'),
+                    COALESCE(min(acquired_at), '1970-01-01')) "interval"
+              FROM {table}
+            ),
+            sources AS (
+              SELECT * FROM (
+                SELECT DISTINCT ON (bbox.idx)
+                  bbox.idx,
+                  1 iterations,
+                  ARRAY[source || ' - ' || url] ids,
+                  ARRAY[url] urls,
+                  ARRAY[source] sources,
+                  ARRAY[resolution] resolutions,
+                  ARRAY[coalesce(bands, '{{}}'::jsonb)] bands,
+                  ARRAY[coalesce(meta, '{{}}'::jsonb)] metas,
+                  ARRAY[coalesce(recipes, '{{}}'::jsonb)] recipes,
+                  ARRAY[acquired_at] acquisition_dates,
+                  ARRAY[priority] priorities,
+                  ARRAY[min_zoom] min_zooms,
+                  ARRAY[max_zoom] max_zooms,
+                  ARRAY[mask] masks,
+                  ARRAY[ST_Area(ST_Intersection(bbox.geom, footprints.geom)) /
+                    ST_Area(bbox.geom)] coverages,
+                  ARRAY[ST_Multi(footprints.geom)] geometries,
+                  ST_Multi(footprints.geom) geom,
+                  ST_Difference(
+                    bbox.geom,
+                    coalesce(
+                      ST_Difference(footprints.geom, footprints.mask),
+                      footprints.geom)) uncovered
+                FROM date_range, {table} footprints
+                JOIN bbox ON ST_Intersects(footprints.geom, bbox.geom)
+                WHERE %(zoom)s BETWEEN min_zoom AND max_zoom
+                  AND footprints.enabled = true
+                ORDER BY
+                  bbox.idx,
+                  10 * coalesce(footprints.priority, 0.5) *
+                    .1 * (1 - (extract(
+                      EPOCH FROM (current_timestamp - COALESCE(
+                        acquired_at, '2000-01-01'))) /
+                        extract(
+                          EPOCH FROM (current_timestamp - date_range.min)))) *
+                    50 *
+                      -- de-prioritize over-zoomed sources
+                      CASE WHEN %(resolution)s / footprints.resolution >= 1
+                        THEN 1
+                        ELSE 1 / footprints.resolution
+                      END *
+                    ST_Area(
+                        ST_Intersection(bbox.geom, footprints.geom)) /
+                      ST_Area(bbox.geom) DESC
+              ) AS _
+              UNION ALL
+              SELECT * FROM (
+                SELECT DISTINCT ON (sources.idx)
+                  sources.idx,
+                  sources.iterations + 1,
+                  sources.ids || ARRAY[source || ' - ' || url] ids,
+                  sources.urls || url urls,
+                  sources.sources || source sources,
+                  sources.resolutions || resolution resolutions,
+                  sources.bands || coalesce(
+                    footprints.bands, '{{}}'::jsonb) bands,
+                  sources.metas || coalesce(meta, '{{}}'::jsonb) metas,
+                  sources.recipes || coalesce(
+                    footprints.recipes, '{{}}'::jsonb) recipes,
+                  sources.acquisition_dates || footprints.acquired_at
+                    acquisition_dates,
+                  sources.priorities || footprints.priority priorities,
+                  sources.min_zooms || footprints.min_zoom min_zooms,
+                  sources.max_zooms || footprints.max_zoom max_zooms,
+                  sources.masks || footprints.mask masks,
+                  sources.coverages || ST_Area(
+                    ST_Intersection(
+                      sources.uncovered,
+                      coalesce(
+                        ST_Difference(footprints.geom, footprints.mask),
+                        footprints.geom))) /
+                    ST_Area(bbox.geom) coverages,
+                  sources.geometries || footprints.geom,
+                  ST_Collect(sources.geom, footprints.geom) geom,
+                  ST_Difference(
+                    sources.uncovered,
+                    coalesce(
+                      ST_Difference(footprints.geom, footprints.mask),
+                      footprints.geom)) uncovered
+                FROM date_range, {table} footprints
+                -- use proper intersection to prevent voids from irregular
+                -- footprints
+                JOIN sources ON ST_Intersects(
+                    footprints.geom, sources.uncovered)
+                JOIN bbox ON bbox.idx = sources.idx
+                WHERE NOT (
+                    (footprints.source || ' - ' || footprints.url) = ANY(sources.ids))
+                  AND %(zoom)s BETWEEN min_zoom AND max_zoom
+                  AND footprints.enabled = true
+                ORDER BY
+                  sources.idx,
+                  10 * coalesce(footprints.priority, 0.5) *
+                    .1 * (1 - (extract(
+                      EPOCH FROM (current_timestamp - COALESCE(
+                        acquired_at, '2000-01-01'))) /
+                        extract(
+                          EPOCH FROM (current_timestamp - date_range.min)))) *
+                    50 *
+                      -- de-prioritize over-zoomed sources
+                      CASE WHEN %(resolution)s / footprints.resolution >= 1
+                        THEN 1
+                        ELSE 1 / footprints.resolution
+                      END *
+                    ST_Area(
+                        ST_Intersection(sources.uncovered, footprints.geom)) /
+                        ST_Area(bbox.geom) DESC
+              ) AS _
+            ),
+            candidates AS (
+                SELECT DISTINCT ON (idx) *
+                FROM sources
+                ORDER BY idx, iterations DESC
+            ), candidate_rows AS (
+                SELECT
+                  idx,
+                  generate_subscripts(urls, 1) position,
+                  unnest(urls) url,
+                  unnest(sources) source,
+                  unnest(resolutions) resolution,
+                  unnest(bands) bands,
+                  unnest(metas) meta,
+                  unnest(recipes) recipes,
+                  unnest(acquisition_dates) acquired_at,
+                  unnest(priorities) priority,
+                  unnest(min_zooms) min_zoom,
+                  unnest(max_zooms) max_zoom,
+                  unnest(coverages) coverage,
+                  unnest(masks) mask,
+                  unnest(geometries) geom
+                FROM candidates
+            )
+            SELECT
+              idx,
+              url,
+              source,
+              resolution,
+              bands,
+              meta,
+              recipes,
+              acquired_at,
+              null band,
+              priority,
+              coverage,
+              CASE WHEN {include_geometries}
+                  THEN ST_AsGeoJSON(geom)
+                  ELSE 'null'
+              END geom,
+              CASE WHEN ST_IsEmpty(mask)
+                THEN 'null'
+                ELSE coalesce(ST_AsGeoJSON(mask), 'null')
+              END mask,
+              min_zoom,
+              max_zoom
+            FROM candidate_rows
+            ORDER BY idx, position
+        """.format(
+            table=self.table,
+            boxes=", ".join(
+                "(%(idx{0})s, %(minx{0})s, %(miny{0})s, %(maxx{0})s, %(maxy{0})s)"
+                .format(i)
+                for i in range(len(bounds_list))
+            ),
+            include_geometries=bool(include_geometries),
+        )
+
+        params = {"zoom": zoom, "resolution": min(resolution)}
+
+        for i, bounds in enumerate(bounds_list):
+            if bounds.crs == WGS84_CRS:
+                left, bottom, right, top = bounds.bounds
+            else:
+                left, bottom, right, top = warp.transform_bounds(
+                    bounds.crs, WGS84_CRS, *bounds.bounds
+                )
+
+            params.update(
+                {
+                    "idx{}".format(i): i,
+                    "minx{}".format(i): left if left != Infinity else -180,
+                    "miny{}".format(i): bottom if bottom != Infinity else -90,
+                    "maxx{}".format(i): right if right != Infinity else 180,
+                    "maxy{}".format(i): top if top != Infinity else 90,
+                }
+            )
+
+        results = [[] for _ in bounds_list]
+
+        connection = self._pool.getconn()
+        try:
+            with connection as conn, conn.cursor() as cur:
+                self._execute(cur, query, params, deadline=deadline)
+
+                for record in cur:
+                    results[record[0]].append(
+                        Source(
+                            *record[1:-4],
+                            geom=json.loads(record[-4]),
+                            mask=json.loads(record[-3]),
+                            min_zoom=record[-2],
+                            max_zoom=record[-1]
+                        )
+                    )
+        except QueryCanceledError:
+            raise DeadlineExceeded("Getting sources")
+        except Exception as e:
+            self._log.exception(e)
+        finally:
+            self._pool.putconn(connection)
+
+        return results
+
+    def _get_sources(
+        self, bounds, resolution, min_zoom, max_zoom, include_geometries, deadline
     ):
         if min_zoom is None or max_zoom is None:
             return self._fill_bounds(
-                bounds, resolution, include_geometries=include_geometries
+                bounds,
+                resolution,
+                include_geometries=include_geometries,
+                deadline=deadline,
             )
 
         return self._candidates(
@@ -358,4 +709,189 @@ class PostGISCatalog(Catalog):
             min_zoom,
             max_zoom,
             include_geometries=include_geometries,
+            deadline=deadline,
         )
+
+    def _from_parent(self, tile, options):
+        """Filter a cached parent tile's sources to those relevant to tile."""
+        if tile.z == 0:
+            return
+
+        sources = self._cache.get(
+            ("tile", tuple(mercantile.parent(tile))) + options
+        )
+
+        if sources is None or any(s.geom is None for s in sources):
+            return
+
+        bounds = mercantile.bounds(tile)
+        (offset, min_zoom, max_zoom, _) = options
+
+        if min_zoom is None or max_zoom is None:
+            # sources were filtered by the zoom corresponding to the query's
+            # resolution (which reflects its scale)
+            zoom = tile.z + offset
+        else:
+            # sources were filtered by the (same) explicit zoom range
+            zoom = None
+
+        # coverage was calculated relative to the parent
+        return [
+            s._replace(coverage=None)
+            for s in sources
+            if _intersects(_geometry_bounds(s.geom), bounds)
+            and (
+                zoom is None
+                or (
+                    (s.min_zoom is None or s.min_zoom <= zoom)
+                    and (s.max_zoom is None or s.max_zoom >= zoom)
+                )
+            )
+        ]
+
+    def _cache_key(self, bounds, resolution, min_zoom, max_zoom, include_geometries):
+        """Generate a cache key for a query, along with the tile it corresponds
+        to (if any) and the options used to key tiles."""
+        if bounds.crs == WGS84_CRS:
+            wgs84_bounds = bounds.bounds
+        else:
+            wgs84_bounds = warp.transform_bounds(bounds.crs, WGS84_CRS, *bounds.bounds)
+
+        zoom = get_zoom(max(resolution))
+        options = (min_zoom, max_zoom, include_geometries)
+        key = (
+            tuple(round(x, CACHE_PRECISION) for x in wgs84_bounds),
+            zoom,
+            round(min(resolution), 3),
+        ) + options
+        tile = _as_tile(wgs84_bounds)
+
+        if tile is not None:
+            # the difference between the tile's zoom and the zoom corresponding
+            # to its resolution reflects its scale
+            options = (zoom - tile.z,) + options
+
+        return key, tile, options
+
+    def _cached(self, key, tile, options):
+        sources = self._cache.get(key)
+
+        if sources is None and tile is not None and self.reuse_parent:
+            sources = self._from_parent(tile, options)
+
+            if sources is not None:
+                # sources were chosen (and ordered) for the parent's bounds
+                # and resolution, so only queried results are reused; derived
+                # ones aren't offered to this tile's children
+                self._store(key, None, options, sources)
+
+        return sources
+
+    def _store(self, key, tile, options, sources):
+        if not sources:
+            # may be the result of an error (which is logged rather than
+            # raised), so don't cache it
+            return
+
+        self._cache.set(key, sources)
+
+        if tile is not None:
+            self._cache.set(("tile", tuple(tile)) + options, sources)
+
+    def get_sources(
+        self,
+        bounds,
+        resolution,
+        min_zoom=None,
+        max_zoom=None,
+        include_geometries=None,
+        deadline=None,
+    ):
+        if include_geometries is None:
+            include_geometries = self.include_geometries
+
+        if self._cache is None:
+            return self._get_sources(
+                bounds, resolution, min_zoom, max_zoom, include_geometries, deadline
+            )
+
+        key, tile, options = self._cache_key(
+            bounds, resolution, min_zoom, max_zoom, include_geometries
+        )
+        sources = self._cached(key, tile, options)
+
+        if sources is None:
+            sources = list(
+                self._get_sources(
+                    bounds,
+                    resolution,
+                    min_zoom,
+                    max_zoom,
+                    include_geometries,
+                    deadline,
+                )
+            )
+            self._store(key, tile, options, sources)
+
+        return sources
+
+    def get_sources_batch(
+        self, bounds_list, resolution, include_geometries=None, deadline=None
+    ):
+        """Fetch sources for many bounds (sharing a resolution) in a single
+        query (for those that aren't cached)."""
+        if include_geometries is None:
+            include_geometries = self.include_geometries
+
+        results = [None] * len(bounds_list)
+        keys = [None] * len(bounds_list)
+
+        if self._cache is not None:
+            for i, bounds in enumerate(bounds_list):
+                keys[i] = self._cache_key(
+                    bounds, resolution, None, None, include_geometries
+                )
+                results[i] = self._cached(*keys[i])
+
+        misses = [i for (i, sources) in enumerate(results) if sources is None]
+
+        if misses:
+            fetched = self._fill_bounds_batch(
+                [bounds_list[i] for i in misses],
+                resolution,
+                include_geometries=include_geometries,
+                deadline=deadline,
+            )
+
+            for i, sources in zip(misses, fetched):
+                results[i] = sources
+
+                if self._cache is not None:
+                    self._store(*(keys[i] + (sources,)))
+
+        return results
+
+    def invalidate(self, bounds=None):
+        """Invalidate cached sources.
+
+        Clears cached sources intersecting bounds (in WGS84), or all of them if
+        bounds is omitted, and increments the catalog's version (invalidating
+        rendered tiles cached using it). Versions aren't persisted, so on-disk
+        tile caches (cache.FileSystemTileCache) must also be cleared.
+        """
+        self._version = (self._version or 0) + 1
+
+        if self._cache is None:
+            return
+
+        if bounds is None:
+            self._cache.clear()
+            return
+
+        def _matches(key):
+            if key[0] == "tile":
+                return _intersects(mercantile.bounds(*key[1]), bounds)
+
+            return _intersects(key[0], bounds)
+
+        self._cache.invalidate_matching(_matches)
@@ -5,7 +5,7 @@ import logging
 
 import mercantile
 import requests
-from marblecutter import get_zoom
+from marblecutter import DeadlineExceeded, get_zoom
 from rasterio import warp
 
 from . import WGS84_CRS, Catalog
@@ -29,7 +29,7 @@ class RemoteCatalog(Catalog):
         self._minzoom = meta["minzoom"]
         self._name = meta["name"]
 
-    def get_sources(self, bounds, resolution):
+    def get_sources(self, bounds, resolution, deadline=None):
         bounds, bounds_crs = bounds
         zoom = get_zoom(max(resolution))
 
@@ -51,8 +51,16 @@ class RemoteCatalog(Catalog):
                         self._minzoom <= zoom <= self._maxzoom):
             tile = mercantile.bounding_tile(left, bottom, right, top)
 
-            with requests.get(
-                    self.endpoint.format(x=tile.x, y=tile.y, z=tile.z)) as rsp:
+            timeout = deadline.remaining() if deadline is not None else None
+
+            try:
+                rsp = requests.get(
+                    self.endpoint.format(x=tile.x, y=tile.y, z=tile.z),
+                    timeout=timeout)
+            except requests.Timeout:
+                raise DeadlineExceeded("Getting sources")
+
+            with rsp:
                 if not rsp:
                     self._log.warn("%s failed: %s", rsp.url, rsp.text)
                     return
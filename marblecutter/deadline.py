@@ -0,0 +1,69 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+# Python 2 doesn't have a monotonic clock
+_clock = getattr(time, "monotonic", time.time)
+
+
+class Deadline(object):
+    """Cancellation token for a render, optionally bounded in time.
+
+    Deadlines are checked between stages and between source reads; when one
+    has passed, DeadlineExceeded is raised (or, when partial results are
+    allowed, compositing stops and whatever has been composited so far is
+    returned). Cancelled renders raise RenderCancelled.
+
+    Keyword Arguments:
+        timeout {float} -- Seconds that the render may take. (default: {None})
+        partial {bool} -- Whether to return partially composited results when
+            the deadline passes during compositing. (default: {False})
+    """
+
+    def __init__(self, timeout=None, partial=False):
+        self.expires_at = None
+        if timeout is not None:
+            self.expires_at = _clock() + timeout
+
+        self.partial = partial
+        # set when compositing stopped early
+        self.truncated = False
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and _clock() >= self.expires_at
+
+    def remaining(self):
+        """Get the number of seconds remaining, or None if unbounded."""
+        if self.expires_at is None:
+            return None
+
+        return max(0, self.expires_at - _clock())
+
+    def check(self, stage=None):
+        """Raise if the render has been cancelled or its deadline has passed.
+
+        Keyword Arguments:
+            stage {str} -- Description of what's being checked for error
+                messages. (default: {None})
+        """
+        # avoid circular dependencies
+        from . import DeadlineExceeded, RenderCancelled
+
+        args = (stage,) if stage else ()
+
+        if self.cancelled:
+            raise RenderCancelled(*args)
+
+        if self.expired:
+            raise DeadlineExceeded(*args)
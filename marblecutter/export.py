@@ -0,0 +1,77 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+
+from . import NoDataAvailable, render_blocks
+from .formats.geotiff import GeoTIFFWriter
+from .stats import METRICS, Timer
+
+LOG = logging.getLogger(__name__)
+
+
+def render_geotiff(
+    path,
+    bounds,
+    shape,
+    target_crs,
+    expand=False,
+    catalog=None,
+    sources=None,
+    transformation=None,
+    blocksize=1024,
+    deadline=None,
+    **options
+):
+    """Render data intersecting bounds into a GeoTIFF, block by block.
+
+    Blocks are written into the output as they're rendered, so memory use is
+    proportional to blocksize rather than to shape. blocksize should be a
+    multiple of the GeoTIFF's internal tile size (512 by default) so that
+    blocks cover whole tiles.
+
+    Arguments:
+        path {str} -- Path to write to.
+        bounds {Bounds} -- Bounds to render.
+        shape {tuple} -- Shape (height, width) of the output.
+        target_crs {rasterio.crs.CRS} -- CRS of the output.
+
+    Keyword Arguments:
+        expand {bool} -- Whether to expand single-band, paletted sources to
+            RGBA. (default: {False})
+        catalog {catalogs.Catalog} -- Catalog to load sources from. (default: {None})
+        sources {list} -- Sources to render from. (default: {None})
+        transformation {Transformation} -- Transformation to apply (which must
+            produce raw data). (default: {None})
+        blocksize {int} -- Width / height of rendered blocks. (default: {1024})
+        deadline {deadline.Deadline} -- Deadline / cancellation token. (default: {None})
+        **options -- Additional arguments for formats.geotiff.GeoTIFFWriter.
+
+    Returns:
+        list -- (name, url) tuples of sources used.
+    """
+    with GeoTIFFWriter(path, bounds, shape, **options) as writer:
+        for (window, pixels, data_format, sources_used, stats, _) in render_blocks(
+            bounds,
+            shape,
+            target_crs,
+            expand,
+            catalog=catalog,
+            sources=sources,
+            transformation=transformation,
+            blocksize=blocksize,
+            deadline=deadline,
+        ):
+            if data_format != "raw":
+                raise Exception("raw data is required")
+
+            with Timer() as t:
+                writer.write(pixels, window, sources_used)
+            stats.append(("Write", t.elapsed))
+
+            METRICS.stages(stats, prefix="export")
+
+    if not writer.opened:
+        raise NoDataAvailable()
+
+    return writer.sources
@@ -2,8 +2,11 @@
 from __future__ import absolute_import
 
 import logging
+import os
+
 import numpy as np
 
+import rasterio
 from rasterio import transform
 from rasterio.io import MemoryFile
 
@@ -12,65 +15,300 @@ from .. import _nodata, get_resolution_in_meters
 CONTENT_TYPE = "image/tiff"
 LOG = logging.getLogger(__name__)
 
+# supported codecs and the creation options that set their levels
+COMPRESSION = {"deflate": "ZLEVEL", "lzw": None, "zstd": "ZSTD_LEVEL", "none": None}
+# threads used to compress blocks (a number or ALL_CPUS)
+NUM_THREADS = os.getenv("MARBLECUTTER_GEOTIFF_NUM_THREADS")
+
+
+def _check(compress):
+    if compress not in COMPRESSION:
+        raise Exception("Unsupported compression: {}".format(compress))
+
+
+def _prepare(data, resolution):
+    """Determine how data will be stored.
+
+    Returns:
+        (np.ma.MaskedArray, int) -- Tuple of (possibly cast) data and TIFF
+            predictor.
+    """
+    (count, _, _) = data.shape
+
+    if np.issubdtype(data.dtype, np.floating):
+        predictor = 3
+
+        if count == 1:
+            # (np.floating + count == 1) == typically DEMs
+            # downsample to int16 if ground resolution is more than 10 meters
+            # (at the equator)
+            if resolution[0] > 10 and resolution[1] > 10:
+                data = data.astype(np.int16)
+                data.fill_value = _nodata(data.dtype)
+
+                # floating point prediction only applies to floats
+                predictor = 2
+    else:
+        predictor = 2
+
+    return data, predictor
+
+
+def _meta(
+    data,
+    bounds,
+    shape,
+    blocksize,
+    predictor,
+    compress="deflate",
+    level=None,
+    num_threads=None,
+):
+    (count, _, _) = data.shape
+    (height, width) = shape
+
+    meta = {
+        "blockxsize": blocksize if width >= blocksize else width,
+        "blockysize": blocksize if height >= blocksize else height,
+        "count": count,
+        "crs": bounds.crs,
+        "dtype": data.dtype,
+        "driver": "GTiff",
+        "nodata": data.fill_value if data.dtype != np.uint8 else None,
+        "height": height,
+        "width": width,
+        "tiled": width >= blocksize and height >= blocksize,
+        "transform": transform.from_bounds(*bounds.bounds, width=width, height=height),
+    }
+
+    if compress != "none":
+        meta["compress"] = compress
+        meta["predictor"] = predictor
+
+        if level is not None and COMPRESSION[compress] is not None:
+            meta[COMPRESSION[compress]] = level
+
+    if num_threads:
+        meta["num_threads"] = num_threads
+
+    return meta
+
+
+def _fill(data, fill_value=None, inplace=False):
+    """Replace masked values with fill_value (or data's fill value).
+
+    Data without masked values is returned as-is. Otherwise it's copied, unless
+    inplace is set, in which case masked values are overwritten in data's own
+    buffer (leaving its mask unchanged); only do this when the caller owns it.
+
+    Returns:
+        np.ndarray -- Filled data.
+    """
+    values = np.ma.getdata(data)
+    mask = np.ma.getmask(data)
+
+    if mask is np.ma.nomask or not mask.any():
+        return values
+
+    if not (inplace and values.flags.writeable):
+        values = values.copy()
+
+    if fill_value is None:
+        fill_value = data.fill_value
+
+    np.copyto(values, np.array(fill_value).astype(values.dtype), where=mask)
+
+    return values
+
 
-def GeoTIFF(area_or_point="Area", blocksize=512, colormap=None):
+def _tag(dataset, area_or_point, sources):
+    dataset.update_tags(AREA_OR_POINT=area_or_point)
+    sources_tag = "\n".join(["{} - {}".format(name, url) for (name, url) in sources])
+    dataset.update_tags(SOURCES=sources_tag)
+
+
+def _write_colormap(dataset, colormap):
+    if dataset.count == 1 and colormap and len(list(colormap.values())[0]) == 3:
+        dataset.write_colormap(1, colormap)
+
+    # TODO set colorinterp (may not be possible)
+    # dataset.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+
+
+def GeoTIFF(
+    area_or_point="Area",
+    blocksize=512,
+    colormap=None,
+    compress="deflate",
+    level=None,
+    num_threads=NUM_THREADS,
+):
+    """GeoTIFF format.
+
+    Keyword Arguments:
+        area_or_point {str} -- AREA_OR_POINT tag value. (default: {"Area"})
+        blocksize {int} -- Internal tile size. (default: {512})
+        colormap {dict} -- Color map to write (for single-band output).
+            (default: {None})
+        compress {str} -- Compression (deflate, lzw, zstd or none).
+            (default: {"deflate"})
+        level {int} -- Compression level (deflate: 1-9, zstd: 1-22); GDAL's
+            default when None. (default: {None})
+        num_threads {str} -- Threads used to compress blocks (a number or
+            ALL_CPUS). (default: {MARBLECUTTER_GEOTIFF_NUM_THREADS})
+    """
+    _check(compress)
 
     def _format(pixels, data_format, sources):
-        data, (data_bounds, data_crs), _, _colormap = pixels
+        data, data_bounds, _, _colormap = pixels
         if data_format is not "raw":
             raise Exception("raw data is required")
 
-        (count, height, width) = data.shape
-        cm = colormap or _colormap
-
-        if np.issubdtype(data.dtype, np.floating):
-            predictor = 3
-
-            if count == 1:
-                # (np.floating + count == 1) == typically DEMs
-                resolution = get_resolution_in_meters(pixels.bounds, (height, width))
-
-                # downsample to int16 if ground resolution is more than 10 meters
-                # (at the equator)
-                if resolution[0] > 10 and resolution[1] > 10:
-                    data = data.astype(np.int16)
-                    data.fill_value = _nodata(data.dtype)
-        else:
-            predictor = 2
-
-        meta = {
-            "blockxsize": blocksize if width >= blocksize else width,
-            "blockysize": blocksize if height >= blocksize else height,
-            "compress": "deflate",
-            "count": count,
-            "crs": data_crs,
-            "dtype": data.dtype,
-            "driver": "GTiff",
-            "nodata": data.fill_value if data.dtype != np.uint8 else None,
-            "predictor": predictor,
-            "height": height,
-            "width": width,
-            "tiled": width >= blocksize and height >= blocksize,
-            "transform": transform.from_bounds(
-                *data_bounds, width=width, height=height
-            ),
-        }
+        (_, height, width) = data.shape
+        data, predictor = _prepare(
+            data, get_resolution_in_meters(pixels.bounds, (height, width))
+        )
+        meta = _meta(
+            data,
+            data_bounds,
+            (height, width),
+            blocksize,
+            predictor,
+            compress=compress,
+            level=level,
+            num_threads=num_threads,
+        )
 
         with MemoryFile() as memfile:
             with memfile.open(**meta) as dataset:
-                dataset.update_tags(AREA_OR_POINT=area_or_point)
-                sources_tag = "\n".join(
-                    ["{} - {}".format(name, url) for (name, url) in sources]
-                )
-                dataset.update_tags(SOURCES=sources_tag)
-                dataset.write(data.filled())
+                _tag(dataset, area_or_point, sources)
+                # _prepare's copies (if any) can be filled in place
+                dataset.write(_fill(data, inplace=data is not pixels.data))
+                _write_colormap(dataset, colormap or _colormap)
 
-                if count == 1 and cm and len(list(cm.values())[0]) == 3:
-                    dataset.write_colormap(1, cm)
+            # copy directly from the in-memory file's buffer (which is freed
+            # when it's closed) rather than reading it like a file
+            return (CONTENT_TYPE, bytes(memfile.getbuffer()))
 
-                # TODO set colorinterp (may not be possible)
-                # dataset.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue, ColorInterp.alpha]
+    return _format
 
-            return (CONTENT_TYPE, memfile.read())
 
-    return _format
+class GeoTIFFWriter(object):
+    """Writes rendered blocks into a GeoTIFF on disk.
+
+    The file is created when the first block is written, as that's when its
+    data type and band count are known (blocks that couldn't be rendered are
+    never written, so a file is only created when there's data).
+
+    Arguments:
+        path {str} -- Path to write to.
+        bounds {Bounds} -- Bounds of the whole output.
+        shape {tuple} -- Shape (height, width) of the whole output.
+
+    Keyword Arguments:
+        area_or_point {str} -- AREA_OR_POINT tag value. (default: {"Area"})
+        blocksize {int} -- Internal tile size. (default: {512})
+        colormap {dict} -- Color map to write (for single-band output).
+            (default: {None})
+        compress {str} -- Compression (deflate, lzw, zstd or none).
+            (default: {"deflate"})
+        level {int} -- Compression level (deflate: 1-9, zstd: 1-22); GDAL's
+            default when None. (default: {None})
+        num_threads {str} -- Threads used to compress blocks (a number or
+            ALL_CPUS). (default: {MARBLECUTTER_GEOTIFF_NUM_THREADS})
+    """
+
+    def __init__(
+        self,
+        path,
+        bounds,
+        shape,
+        area_or_point="Area",
+        blocksize=512,
+        colormap=None,
+        compress="deflate",
+        level=None,
+        num_threads=NUM_THREADS,
+    ):
+        _check(compress)
+
+        self.path = path
+        self.bounds = bounds
+        self.shape = shape
+        self.area_or_point = area_or_point
+        self.blocksize = blocksize
+        self.colormap = colormap
+        self.compress = compress
+        self.level = level
+        self.num_threads = num_threads
+        self.resolution = get_resolution_in_meters(bounds, shape)
+        self.sources = []
+        self._dataset = None
+        self._fill_value = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ty, val, tb):
+        self.close()
+
+    @property
+    def opened(self):
+        return self._dataset is not None
+
+    def write(self, pixels, window, sources=None):
+        """Write a block.
+
+        Arguments:
+            pixels {PixelCollection} -- Raw pixels for the block.
+            window {rasterio.windows.Window} -- Window within the output that
+                the block covers.
+
+        Keyword Arguments:
+            sources {list} -- (name, url) tuples of sources used to render the
+                block. (default: {None})
+        """
+        data, predictor = _prepare(pixels.data, self.resolution)
+
+        if self._dataset is None:
+            meta = _meta(
+                data,
+                self.bounds,
+                self.shape,
+                self.blocksize,
+                predictor,
+                compress=self.compress,
+                level=self.level,
+                num_threads=self.num_threads,
+            )
+            meta["BIGTIFF"] = "IF_SAFER"
+
+            LOG.info("Creating %s (%d x %d)", self.path, meta["width"], meta["height"])
+            self._dataset = rasterio.open(self.path, "w", **meta)
+            self._fill_value = data.fill_value
+            self.colormap = self.colormap or pixels.colormap
+
+        if data.dtype != self._dataset.dtypes[0]:
+            # blocks are composited independently, so their dtypes may differ
+            data = data.astype(self._dataset.dtypes[0])
+
+        # copies made above (if any) can be filled in place
+        self._dataset.write(
+            _fill(data, self._fill_value, inplace=data is not pixels.data),
+            window=window,
+        )
+
+        for source in sources or []:
+            if source not in self.sources:
+                self.sources.append(source)
+
+    def close(self):
+        if self._dataset is None or self._dataset.closed:
+            return
+
+        try:
+            # sources are only known once all blocks have been written
+            _tag(self._dataset, self.area_or_point, self.sources)
+            _write_colormap(self._dataset, self.colormap)
+        finally:
+            self._dataset.close()
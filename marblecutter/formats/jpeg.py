@@ -6,19 +6,45 @@ from io import BytesIO
 from PIL import Image
 
 from .. import _isimage
+from ..stats import METRICS, Timer
 
 CONTENT_TYPE = "image/jpeg"
 
 
-def JPEG():
+def JPEG(quality=75, subsampling=None, progressive=False, optimize=False):
+    """JPEG format.
+
+    JPEGs can't be transparent, so the alpha channel of RGBA images is
+    dropped.
+
+    Keyword Arguments:
+        quality {int} -- Quality (1-95). (default: {75})
+        subsampling {str} -- Chroma subsampling ("4:4:4", "4:2:2" or "4:2:0");
+            None for the encoder's default. (default: {None})
+        progressive {bool} -- Whether to write progressive JPEGs.
+            (default: {False})
+        optimize {bool} -- Whether to compute optimal Huffman tables (smaller
+            but slower). (default: {False})
+    """
+    options = {"quality": quality, "progressive": progressive, "optimize": optimize}
+
+    if subsampling is not None:
+        options["subsampling"] = subsampling
 
     def _format(pixels, data_format, sources):
         if not _isimage(data_format):
             raise Exception("Must be an image format")
 
-        out = BytesIO()
-        im = Image.fromarray(pixels.data, data_format.upper())
-        im.save(out, "jpeg")
+        data = pixels.data
+        if data_format.upper() == "RGBA":
+            data = data[:, :, 0:3]
+
+        with Timer() as t:
+            out = BytesIO()
+            im = Image.fromarray(data, "RGB")
+            im.save(out, "jpeg", **options)
+
+        METRICS.timing("jpeg.encode_seconds", t.elapsed)
 
         return (CONTENT_TYPE, out.getvalue())
 
@@ -3,34 +3,49 @@ from __future__ import absolute_import
 
 import logging
 
-import numpy as np
-
-from .. import _isimage
+from .. import _isempty, _isimage, _isopaque
 from ..utils import PixelCollection
 from .jpeg import JPEG
-from .png import PNG
+from .png import CONTENT_TYPE as PNG_CONTENT_TYPE
+from .png import PNG, _transparent
 
 LOG = logging.getLogger(__name__)
 JPEG_FORMAT = JPEG()
 PNG_FORMAT = PNG()
 
 
-def Optimal():
+def Optimal(opaque=None, transparent=None):
+    """Chooses a format based on whether images are transparent.
+
+    Keyword Arguments:
+        opaque {function} -- Format for opaque images (e.g. JPEG or lossy
+            WebP). (default: {JPEG()})
+        transparent {function} -- Format for (partially) transparent images
+            (e.g. PNG or WebP). (default: {PNG()})
+    """
+    opaque = opaque or JPEG_FORMAT
+    transparent = transparent or PNG_FORMAT
 
     def _format(pixels, data_format, sources):
         if not _isimage(data_format):
             raise Exception("Must be an image format")
 
-        alpha = pixels.data[:, :, 3]
+        if data_format.upper() == "RGB":
+            # solid
+            return opaque(pixels, data_format, sources)
 
-        if np.equal(alpha, 255).all():
+        if _isempty(pixels.data) and transparent is PNG_FORMAT:
+            # nothing to encode; use a shared, pre-encoded transparent tile
+            return (PNG_CONTENT_TYPE, _transparent(pixels.data.shape[:2]))
+
+        if _isopaque(pixels.data):
             # solid
             rgb_pixels = PixelCollection(
                 pixels.data[:, :, 0:3], pixels.bounds, pixels.band
             )
-            return JPEG_FORMAT(rgb_pixels, "RGB", sources)
-        else:
-            # partially transparent
-            return PNG_FORMAT(pixels, data_format, sources)
+            return opaque(rgb_pixels, "RGB", sources)
+
+        # partially transparent
+        return transparent(pixels, data_format, sources)
 
     return _format
@@ -1,29 +1,320 @@
 # coding=utf-8
-from __future__ import absolute_import
+"""PNG encoding using zlib directly.
 
+Filtering is vectorized with numpy (rather than done row by row), opaque RGBA
+is written as RGB, fully transparent tiles are pre-encoded, and tiles with 256
+or fewer distinct colors are written exactly as paletted PNGs.
+"""
+from __future__ import absolute_import, division
+
+import logging
+import struct
+import zlib
 from io import BytesIO
 
+import numpy as np
 from PIL import Image
 
-from .. import _isimage
+from .. import _isempty, _isimage, _isopaque
+from ..cache import LRUCache
+from ..stats import METRICS, Timer
 
 CONTENT_TYPE = "image/png"
+LOG = logging.getLogger(__name__)
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# color types by channel count
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+PALETTE_COLOR_TYPE = 3
+
+FILTERS = ("none", "sub", "up", "average", "paeth")
+STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    # Z_RLE isn't available in Python 2
+    "rle": getattr(zlib, "Z_RLE", zlib.Z_DEFAULT_STRATEGY),
+}
+
+# number of pixels sampled to rule out palettes before counting all colors
+PALETTE_SAMPLE_SIZE = 4096
+
+# pre-encoded transparent tiles, keyed by shape
+TRANSPARENT_CACHE = LRUCache(max_size=16)
+
+
+def _chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+    )
+
+
+def _filter(rows, bpp, method):
+    """Apply a PNG filter to each row of a 2D uint8 array (rows x bytes).
+
+    Returns:
+        np.ndarray -- Filtered rows.
+    """
+    if method == "none":
+        return rows
+
+    # neighbors to the left, above and above-left (zero outside the image)
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+
+    above = np.zeros_like(rows)
+    above[1:] = rows[:-1]
+
+    if method == "sub":
+        return rows - left
+
+    if method == "up":
+        return rows - above
+
+    if method == "average":
+        return rows - ((left.astype(np.uint16) + above) >> 1).astype(np.uint8)
+
+    upper_left = np.zeros_like(rows)
+    upper_left[1:, bpp:] = rows[:-1, :-bpp]
+
+    a = left.astype(np.int16)
+    b = above.astype(np.int16)
+    c = upper_left.astype(np.int16)
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - c - c)
+    predictor = np.where(pb <= pc, above, upper_left)
+    np.copyto(predictor, left, where=(pa <= pb) & (pa <= pc))
+
+    return rows - predictor
+
+
+def _filter_rows(rows, bpp, method):
+    """Filter rows, prefixing each with its filter type.
+
+    "adaptive" chooses the filter that minimizes the sum of absolute (signed)
+    differences for each row, as libpng does.
+    """
+    if method != "adaptive":
+        types = np.full((rows.shape[0], 1), FILTERS.index(method), np.uint8)
+        return np.hstack((types, _filter(rows, bpp, method)))
+
+    candidates = np.stack([_filter(rows, bpp, f) for f in FILTERS])
+    # |x| of bytes interpreted as signed is min(x, 256 - x)
+    scores = np.minimum(candidates, 0 - candidates).sum(axis=2, dtype=np.uint32)
+    types = scores.argmin(axis=0)
+    filtered = candidates[types, np.arange(rows.shape[0])]
+
+    return np.hstack((types.astype(np.uint8)[:, np.newaxis], filtered))
+
+
+def encode(
+    data,
+    palette=None,
+    transparency=None,
+    level=6,
+    strategy=None,
+    filter="adaptive",
+):
+    """Encode an image as PNG.
+
+    Arguments:
+        data {np.ndarray} -- uint8 array of shape (height, width, channels)
+            (1-4 channels: L, LA, RGB or RGBA) or, when a palette is provided,
+            (height, width) palette indices.
+
+    Keyword Arguments:
+        palette {np.ndarray} -- (n, 3) uint8 palette. (default: {None})
+        transparency {np.ndarray} -- Alpha values for palette entries.
+            (default: {None})
+        level {int} -- zlib compression level (0-9). (default: {6})
+        strategy {str} -- zlib strategy (default, filtered, huffman or rle);
+            None for filtered when rows are filtered and default otherwise,
+            as libpng does. (default: {None})
+        filter {str} -- Row filter (none, sub, up, average, paeth or
+            adaptive); paletted images are never filtered. (default:
+            {"adaptive"})
+
+    Returns:
+        bytes -- PNG.
+    """
+    if palette is not None:
+        (height, width) = data.shape
+        channels = 1
+        color_type = PALETTE_COLOR_TYPE
+        filter = "none"
+    else:
+        (height, width, channels) = data.shape
+        color_type = COLOR_TYPES[channels]
+
+    if strategy is None:
+        strategy = "default" if filter == "none" else "filtered"
+
+    rows = np.ascontiguousarray(data).reshape(height, width * channels)
+    compressor = zlib.compressobj(
+        level, zlib.DEFLATED, zlib.MAX_WBITS, 9, STRATEGIES[strategy]
+    )
+    compressed = compressor.compress(
+        _filter_rows(rows, channels, filter).tobytes()
+    ) + compressor.flush()
+
+    chunks = [
+        SIGNATURE,
+        _chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+        ),
+    ]
+
+    if palette is not None:
+        chunks.append(_chunk(b"PLTE", np.asarray(palette, np.uint8).tobytes()))
+
+        if transparency is not None:
+            # trailing opaque entries may be omitted
+            alpha = np.asarray(transparency, np.uint8)
+            opaque = np.nonzero(alpha != 255)[0]
+            if len(opaque) > 0:
+                chunks.append(_chunk(b"tRNS", alpha[: opaque[-1] + 1].tobytes()))
+
+    chunks.append(_chunk(b"IDAT", compressed))
+    chunks.append(_chunk(b"IEND", b""))
 
+    return b"".join(chunks)
 
-def PNG(paletted=False):
+
+def _pack(pixels):
+    """Pack (n, channels) uint8 pixels into integers so that they can be
+    compared at once."""
+    packed = np.zeros(pixels.shape[0], np.uint32)
+    for i in range(pixels.shape[1]):
+        packed |= pixels[:, i].astype(np.uint32) << (8 * i)
+
+    return packed
+
+
+def _colors(data):
+    """Determine the distinct colors in data (if there are at most 256).
+
+    Returns:
+        (np.ndarray, np.ndarray) -- Tuple of colors (n x channels) and
+            per-pixel indices into them, or None if there are more than 256.
+    """
+    (height, width, channels) = data.shape
+    pixels = data.reshape(-1, channels)
+
+    # cheaply rule out imagery before counting everything
+    step = max(1, pixels.shape[0] // PALETTE_SAMPLE_SIZE)
+    if len(np.unique(_pack(pixels[::step]))) > 256:
+        return None
+
+    colors, indices = np.unique(_pack(pixels), return_inverse=True)
+    if len(colors) > 256:
+        return None
+
+    unpacked = np.stack(
+        [(colors >> (8 * i)) & 0xff for i in range(channels)], axis=1
+    ).astype(np.uint8)
+
+    return unpacked, indices.reshape(height, width).astype(np.uint8)
+
+
+def _transparent(shape, **options):
+    key = (shape, tuple(sorted(options.items())))
+    data = TRANSPARENT_CACHE.get(key)
+
+    if data is None:
+        data = encode(
+            np.zeros(shape, np.uint8),
+            palette=np.zeros((1, 3), np.uint8),
+            transparency=np.zeros(1, np.uint8),
+            **options
+        )
+        TRANSPARENT_CACHE.set(key, data)
+
+    return data
+
+
+def _encode(data, data_format, paletted, **options):
+    """Choose how to encode data.
+
+    Returns:
+        (str, bytes) -- Tuple of the encoding path taken and PNG.
+    """
+    if data.dtype != np.uint8:
+        im = Image.fromarray(data, data_format.upper())
+        out = BytesIO()
+        im.save(out, "png", compress_level=options["level"])
+        return "pil", out.getvalue()
+
+    if data_format.upper() == "RGBA":
+        if _isempty(data):
+            return "transparent", _transparent(data.shape[:2], **options)
+
+        alpha = data[:, :, 3]
+
+        if not alpha.any():
+            return "transparent", _transparent(data.shape[:2], **options)
+
+        if _isopaque(data):
+            data = data[:, :, 0:3]
+
+    colors = _colors(data)
+
+    if colors is not None:
+        palette, indices = colors
+        transparency = palette[:, 3] if palette.shape[1] == 4 else None
+
+        return "palette", encode(
+            indices, palette=palette[:, 0:3], transparency=transparency, **options
+        )
+
+    if paletted:
+        # lossy quantization (more than 256 colors)
+        im = Image.fromarray(np.ascontiguousarray(data)).convert("P", dither="NONE")
+        out = BytesIO()
+        im.save(out, "png", compress_level=options["level"])
+        return "quantized", out.getvalue()
+
+    return "rgb" if data.shape[2] == 3 else "rgba", encode(data, **options)
+
+
+def PNG(paletted=False, level=6, strategy=None, filter="adaptive"):
+    """PNG format.
+
+    Keyword Arguments:
+        paletted {bool} -- Whether to quantize images with more than 256
+            colors (lossily). (default: {False})
+        level {int} -- zlib compression level (0-9). (default: {6})
+        strategy {str} -- zlib strategy (default, filtered, huffman or rle);
+            None for filtered when rows are filtered and default otherwise.
+            (default: {None})
+        filter {str} -- Row filter (none, sub, up, average, paeth or
+            adaptive). (default: {"adaptive"})
+    """
+    if strategy is not None and strategy not in STRATEGIES:
+        raise Exception("Unsupported strategy: {}".format(strategy))
+
+    if filter not in FILTERS + ("adaptive",):
+        raise Exception("Unsupported filter: {}".format(filter))
 
     def _format(pixels, data_format, sources):
         if not _isimage(data_format):
             raise Exception("Must be an image format")
 
-        out = BytesIO()
-        im = Image.fromarray(pixels.data, data_format.upper())
-
-        if paletted:
-            im = im.convert("P", dither="NONE")
+        with Timer() as t:
+            path, data = _encode(
+                pixels.data,
+                data_format,
+                paletted,
+                level=level,
+                strategy=strategy,
+                filter=filter,
+            )
 
-        im.save(out, "png")
+        METRICS.timing("png.encode_seconds", t.elapsed, path=path)
 
-        return (CONTENT_TYPE, out.getvalue())
+        return (CONTENT_TYPE, data)
 
     return _format
@@ -0,0 +1,49 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from io import BytesIO
+
+from PIL import Image, features
+
+from .. import _isimage
+from ..stats import METRICS, Timer
+
+CONTENT_TYPE = "image/webp"
+
+
+def WebP(quality=80, lossless=False, method=4, alpha_quality=100):
+    """WebP format (lossy or lossless, preserving transparency).
+
+    Keyword Arguments:
+        quality {int} -- Quality (0-100); for lossless images, the effort
+            spent compressing. (default: {80})
+        lossless {bool} -- Whether to encode losslessly. (default: {False})
+        method {int} -- Trade-off between encoding speed and size (0-6, fast
+            to small). (default: {4})
+        alpha_quality {int} -- Quality of the alpha channel for lossy images
+            (0-100). (default: {100})
+    """
+    if not features.check("webp"):
+        raise Exception("WebP support is unavailable (Pillow lacks libwebp)")
+
+    options = {
+        "quality": quality,
+        "lossless": lossless,
+        "method": method,
+        "alpha_quality": alpha_quality,
+    }
+
+    def _format(pixels, data_format, sources):
+        if not _isimage(data_format):
+            raise Exception("Must be an image format")
+
+        with Timer() as t:
+            out = BytesIO()
+            im = Image.fromarray(pixels.data, data_format.upper())
+            im.save(out, "webp", **options)
+
+        METRICS.timing("webp.encode_seconds", t.elapsed, lossless=lossless)
+
+        return (CONTENT_TYPE, out.getvalue())
+
+    return _format
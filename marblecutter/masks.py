@@ -0,0 +1,131 @@
+# coding=utf-8
+"""Source masks, reprojected once and indexed by part."""
+from __future__ import absolute_import, division
+
+import logging
+import os
+
+import numpy as np
+
+import rasterio
+from rasterio import warp
+from rasterio.features import geometry_mask
+from rasterio.transform import from_bounds
+
+from .cache import LRUCache
+
+LOG = logging.getLogger(__name__)
+# reprojected masks, keyed by source URL and CRS (catalogs return complete
+# masks, so they're the same for every tile a source is used for)
+MASK_CACHE = LRUCache(
+    max_size=int(os.getenv("MARBLECUTTER_MASK_CACHE_SIZE", 256)),
+    ttl=int(os.getenv("MARBLECUTTER_MASK_CACHE_TTL", 300)),
+)
+
+
+def _parts(geom):
+    """Split a geometry into its component polygons."""
+    if geom["type"] == "Polygon":
+        return [geom]
+
+    if geom["type"] == "MultiPolygon":
+        return [
+            {"type": "Polygon", "coordinates": coordinates}
+            for coordinates in geom["coordinates"]
+        ]
+
+    if geom["type"] == "GeometryCollection":
+        return [part for g in geom["geometries"] for part in _parts(g)]
+
+    return [geom]
+
+
+def _flatten(coordinates):
+    if len(coordinates) and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for c in coordinates:
+            for point in _flatten(c):
+                yield point
+
+
+def _bounds(geom):
+    if geom["type"] == "Polygon":
+        # the exterior ring contains any holes
+        points = np.asarray(geom["coordinates"][0], dtype=np.float64)
+    else:
+        points = np.asarray(list(_flatten(geom["coordinates"])), dtype=np.float64)
+
+    if points.size == 0:
+        return (np.inf, np.inf, -np.inf, -np.inf)
+
+    return tuple(points[:, :2].min(axis=0)) + tuple(points[:, :2].max(axis=0))
+
+
+class Mask(object):
+    """A mask geometry in a specific CRS, split into parts with an index of
+    their bounds so that only parts intersecting a target are rasterized.
+
+    Arguments:
+        parts {list} -- GeoJSON geometries.
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.bounds = np.array([_bounds(part) for part in parts]).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.parts)
+
+    def intersecting(self, bounds):
+        """Get the parts whose bounds intersect bounds."""
+        w, s, e, n = bounds
+        b = self.bounds
+        hits = (b[:, 0] <= e) & (b[:, 1] <= n) & (b[:, 2] >= w) & (b[:, 3] >= s)
+
+        return [self.parts[i] for i in np.flatnonzero(hits)]
+
+    def rasterize(self, bounds, shape, all_touched=False):
+        """Rasterize the mask into shape covering bounds.
+
+        Returns:
+            ndarray -- Boolean array that's True within the mask, or nomask if
+                the mask doesn't intersect bounds.
+        """
+        parts = self.intersecting(bounds)
+
+        if not parts:
+            return np.ma.nomask
+
+        return geometry_mask(
+            parts,
+            shape,
+            transform=from_bounds(*bounds, width=shape[1], height=shape[0]),
+            all_touched=all_touched,
+            invert=True,
+        )
+
+
+def get_mask(source, crs):
+    """Get a source's mask reprojected into crs (cached).
+
+    Returns:
+        Mask -- Reprojected mask, or None if the source isn't masked.
+    """
+    # avoid circular dependencies
+    from . import WGS84_CRS
+
+    if not source.mask:
+        return None
+
+    key = (source.url, crs.to_string())
+    mask = MASK_CACHE.get(key)
+
+    if mask is None:
+        with rasterio.Env(OGR_ENABLE_PARTIAL_REPROJECTION=True):
+            geom = warp.transform_geom(WGS84_CRS, crs, source.mask)
+
+        mask = Mask(_parts(geom))
+        MASK_CACHE.set(key, mask)
+
+    return mask
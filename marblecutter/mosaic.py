@@ -2,24 +2,322 @@
 from __future__ import absolute_import, division, print_function
 
 import logging
+import math
 import multiprocessing
-from concurrent import futures
+import os
 
 import numpy as np
 
+import rasterio
 from rasterio import warp
+from rasterio._err import CPLE_OutOfMemoryError
+from rasterio.features import rasterize
+from rasterio.transform import from_bounds
 
 from . import recipes
+from .masks import get_mask
+from .pool import ReadPool
+from .stats import METRICS, Timer
 from .utils import Bounds, PixelCollection
 
 LOG = logging.getLogger(__name__)
+READ_POOL = ReadPool(
+    int(os.getenv("MARBLECUTTER_READ_POOL_SIZE", multiprocessing.cpu_count() * 5)),
+    queue_depth=int(os.getenv("MARBLECUTTER_READ_QUEUE_DEPTH", 0)) or None,
+    concurrency=int(os.getenv("MARBLECUTTER_READ_CONCURRENCY", 0)) or None,
+    name="read_pool",
+)
+# number of sources to read ahead of the one being composited
+READ_LOOKAHEAD = int(os.getenv("MARBLECUTTER_READ_LOOKAHEAD", 4)) or None
+# factor by which footprints are downsampled (relative to the target shape) when
+# planning
+PLAN_SCALE = 8
+
+
+def _rasterize_footprint(geom, out_shape, transform, all_touched):
+    return rasterize(
+        [(geom, 1)],
+        out_shape=out_shape,
+        transform=transform,
+        all_touched=all_touched,
+        dtype=np.uint8,
+    ).astype(np.bool_)
+
+
+def _boundary(geom):
+    """Get the rings of a (multi-)polygon as a MultiLineString."""
+    if geom["type"] == "Polygon":
+        rings = geom["coordinates"]
+    elif geom["type"] == "MultiPolygon":
+        rings = [ring for polygon in geom["coordinates"] for ring in polygon]
+    else:
+        return None
+
+    return {"type": "MultiLineString", "coordinates": rings}
+
+
+def _rasterize_interior(geom, out_shape, transform):
+    """Rasterize the pixels that are entirely within geom (i.e. those that
+    geom's boundary doesn't pass through)."""
+    interior = _rasterize_footprint(geom, out_shape, transform, False)
+    boundary = _boundary(geom)
+
+    if boundary is None:
+        return np.zeros(out_shape, dtype=np.bool_)
+
+    return interior & ~_rasterize_footprint(boundary, out_shape, transform, True)
+
+
+def plan(sources, bounds, shape):
+    """Prune sources whose footprints are entirely occluded by higher-priority
+    sources.
+
+    Only sources known to be opaque within their footprints (less their masks)
+    occlude others: those whose metadata includes `"opaque": true` (i.e.
+    without nodata or internal masks). Footprints (and masks) are rasterized at
+    a fraction of the target resolution; coarse pixels are only considered
+    covered when they're entirely within an opaque footprint. Sources without
+    footprints (or that only provide a single band) are always read.
+
+    When no source is opaque, nothing can be occluded, so sources are returned
+    as-is.
+
+    Returns:
+        (list, list) -- Tuple of sources to read and sources that were skipped.
+    """
+    from . import WGS84_CRS
+
+    sources = list(sources)
+
+    if not any(source.meta.get("opaque") for source in sources):
+        return sources, []
+
+    out_shape = tuple(max(1, int(math.ceil(dim / PLAN_SCALE))) for dim in shape)
+    transform = from_bounds(*bounds.bounds, width=out_shape[1], height=out_shape[0])
+    covered = np.zeros(out_shape, dtype=np.bool_)
+
+    selected = []
+    skipped = []
+
+    for source in sources:
+        if source.geom is None or source.band is not None:
+            selected.append(source)
+            continue
+
+        try:
+            with rasterio.Env(OGR_ENABLE_PARTIAL_REPROJECTION=True):
+                geom = warp.transform_geom(WGS84_CRS, bounds.crs, source.geom)
+
+            mask = get_mask(source, bounds.crs)
+
+            # be generous when checking whether a source contributes
+            footprint = _rasterize_footprint(geom, out_shape, transform, True)
+        except Exception as e:
+            LOG.warning("Unable to plan for %s: %s", source.url, e)
+            selected.append(source)
+            continue
+
+        if not (footprint & ~covered).any():
+            skipped.append(source)
+            continue
+
+        selected.append(source)
+
+        if not source.meta.get("opaque"):
+            continue
+
+        # be conservative when marking pixels as covered
+        interior = _rasterize_interior(geom, out_shape, transform)
+        if mask is not None:
+            masked = mask.rasterize(bounds.bounds, out_shape, all_touched=True)
+            if masked is not np.ma.nomask:
+                interior &= ~masked
+
+        covered |= interior
+
+    return selected, skipped
+
+
+def _colormap(src, source, expand):
+    """Choose the colormap to apply to a source's data, if any."""
+    # load a colormap, if available
+    _colormap = None
+    try:
+        _colormap = src.colormap(1)
+    except ValueError:
+        pass
+
+    if expand == "meta":
+        # only use colormap from metadata
+        return source.meta.get("colormap", _colormap)
+
+    return source.recipes.get("colormap", source.meta.get("colormap", _colormap))
+
+
+def _read(src, source, canvas_bounds, shape, info):
+    """Read a window from a source, from the coarsest sufficient overview.
+
+    info is updated with the overview level used (and read_window's timings).
+    """
+    # avoid circular dependencies
+    from . import (
+        DataReadFailed,
+        InsufficientMemory,
+        get_overview_level,
+        get_source,
+        read_window,
+    )
+
+    try:
+        info["overview"] = get_overview_level(src, canvas_bounds, shape)
+
+        if info["overview"] is None:
+            return read_window(src, canvas_bounds, shape, source, timings=info)
+
+        with get_source(source.url, overview_level=info["overview"]) as overview:
+            return read_window(overview, canvas_bounds, shape, source, timings=info)
+    except (CPLE_OutOfMemoryError, MemoryError) as e:
+        METRICS.increment("read.failures")
+
+        raise InsufficientMemory(
+            "Out of memory reading {}: {}".format(source.url, str(e))
+        )
+    except Exception as e:
+        METRICS.increment("read.failures")
+
+        raise DataReadFailed("Error reading {}: {}".format(source.url, str(e)))
+
+
+def _read_source(source, canvas_bounds, shape, expand, stats=None, deadline=None):
+    """Read a source's data (see composite()).
+
+    Returns:
+        (Source, PixelCollection) -- Tuple of the source and its data.
+    """
+    # avoid circular dependencies
+    from . import get_source
+
+    if deadline is not None:
+        deadline.check("Reading {}".format(source.url))
+
+    with get_source(source.url) as src:
+        LOG.info(
+            "Fetching %s (%s) as band %s", source.url, source.name, source.band or "*"
+        )
+
+        colormap = _colormap(src, source, expand)
 
+        if colormap:
+            # tell read_window to use mode resampling (if not set
+            # otherwise), since it won't see this source as paletted
+            source.recipes["resample"] = source.recipes.get("resample", "mode")
 
-def composite(sources, bounds, shape, target_crs, expand):
+        # read a window from the source data
+        # TODO ask for a buffer here, get back an updated bounding box
+        # reflecting it
+        info = {}
+        with Timer() as t:
+            window_data = _read(src, source, canvas_bounds, shape, info)
+
+        # bytes read from sources aren't exposed by GDAL (nor are block
+        # cache hits), so record the size of the decoded data
+        info["read_seconds"] = t.elapsed
+        info["bytes"] = window_data.data.nbytes
+
+        method = "warp" if "vrt_seconds" in info else "direct"
+        METRICS.timing("read.duration_seconds", t.elapsed, method=method)
+        METRICS.size("read.decoded_bytes", info["bytes"])
+        if "vrt_seconds" in info:
+            METRICS.timing("read.vrt_build_seconds", info["vrt_seconds"])
+
+        if stats is not None:
+            stats.append((source, info))
+
+        return (
+            source,
+            PixelCollection(
+                window_data.data, window_data.bounds, source.band, colormap
+            ),
+        )
+
+
+def _paste_windows(windows, canvas_bounds, expand, sources_used, deadline=None):
+    """Paste windows onto a canvas (in order) until all of its pixels are
+    filled.
+
+    Sources are appended to sources_used as they're pasted.
+
+    Returns:
+        PixelCollection -- Canvas, or None if nothing was pasted.
+    """
+    # avoid circular dependencies
+    from . import DeadlineExceeded, _nodata
+
+    canvas = None
+
+    try:
+        for source, window_data in windows:
+            if deadline is not None:
+                deadline.check("Compositing")
+
+            window_data = recipes.apply(
+                source.recipes, window_data, source=source, expand=expand
+            )
+
+            if window_data.data is None:
+                continue
+
+            if canvas is None:
+                # initialize canvas data
+                canvas_data = np.ma.zeros(
+                    window_data.data.shape,
+                    dtype=window_data.data.dtype,
+                    fill_value=_nodata(window_data.data.dtype),
+                )
+                canvas_data.mask = True
+
+                canvas = PixelCollection(
+                    canvas_data, canvas_bounds, None, window_data.colormap
+                )
+
+            # paste the resulting data onto a canvas (casting as necessary)
+            canvas = paste(window_data, canvas)
+            sources_used.append(source)
+
+            if not canvas.data.mask.any():
+                # stop if all pixels are valid
+                break
+    except DeadlineExceeded:
+        if not (deadline.partial and canvas is not None):
+            raise
+
+        LOG.warning(
+            "Deadline exceeded; returning partial results from %d sources",
+            len(sources_used),
+        )
+        deadline.truncated = True
+
+    return canvas
+
+
+def composite(
+    sources, bounds, shape, target_crs, expand, stats=None, deadline=None
+):
     """Composite data from sources into a single raster covering bounds, but in
-    the target CRS."""
+    the target CRS.
+
+    When stats is a list, (source, dict) pairs describing each source read
+    (the overview level used, read and VRT build times, and the number of
+    bytes read) are appended to it.
+
+    deadline (a deadline.Deadline) is checked before each read and paste. If
+    it's cancelled or has passed, outstanding reads are abandoned and the
+    corresponding exception is raised, unless the deadline allows partial
+    results and something has been composited, in which case that is returned
+    (and deadline.truncated is set).
+    """
     # avoid circular dependencies
-    from . import _nodata, get_resolution_in_meters, get_source, read_window
+    from . import get_resolution_in_meters
 
     # TODO this belongs in render
     if bounds.crs == target_crs:
@@ -33,107 +331,58 @@ def composite(sources, bounds, shape, target_crs, expand):
     sources = recipes.preprocess(sources, resolution=resolution)
 
     def _read_window(source):
-        with get_source(source.url) as src:
-            LOG.info(
-                "Fetching %s (%s) as band %s",
-                source.url,
-                source.name,
-                source.band or "*",
-            )
-
-            # load a colormap, if available
-            _colormap = None
-            try:
-                _colormap = src.colormap(1)
-            except ValueError:
-                pass
-
-            if expand == "meta":
-                # only use colormap from metadata
-                colormap = source.meta.get("colormap", _colormap)
-            else:
-                colormap = source.recipes.get(
-                    "colormap", source.meta.get("colormap", _colormap)
-                )
-
-            if colormap:
-                # tell read_window to use mode resampling (if not set
-                # otherwise), since it won't see this source as paletted
-                source.recipes["resample"] = source.recipes.get("resample", "mode")
-
-            # read a window from the source data
-            # TODO ask for a buffer here, get back an updated bounding box
-            # reflecting it
-            try:
-                window_data = read_window(src, canvas_bounds, shape, source)
-            except Exception as e:
-                from . import DataReadFailed
-
-                raise DataReadFailed(
-                    "Error reading {}: {}".format(source.url, str(e))
-                )
-
-            return (
-                source,
-                PixelCollection(
-                    window_data.data, window_data.bounds, source.band, colormap
-                ),
-            )
+        return _read_source(
+            source, canvas_bounds, shape, expand, stats=stats, deadline=deadline
+        )
 
-    # iterate over available sources, sorted by decreasing "quality"
-    with futures.ThreadPoolExecutor(
-        max_workers=multiprocessing.cpu_count() * 5
-    ) as executor:
-        ws = executor.map(_read_window, sources)
+    # iterate over available sources, sorted by decreasing "quality", reading
+    # ahead of the window being composited
+    reads = READ_POOL.imap(
+        _read_window, sources, lookahead=READ_LOOKAHEAD, deadline=deadline
+    )
 
     sources_used = []
 
-    ws = recipes.postprocess(ws)
-
-    canvas = None
-
-    for source, window_data in filter(None, ws):
-        window_data = recipes.apply(
-            source.recipes, window_data, source=source, expand=expand
+    try:
+        canvas = _paste_windows(
+            recipes.postprocess(reads),
+            canvas_bounds,
+            expand,
+            sources_used,
+            deadline=deadline,
         )
+    finally:
+        # cancel reads that are no longer needed
+        reads.close()
 
-        if window_data.data is None:
-            continue
+    return [(s.name, s.url) for s in sources_used], canvas
 
-        if canvas is None:
-            # initialize canvas data
-            canvas_data = np.ma.zeros(
-                window_data.data.shape,
-                dtype=window_data.data.dtype,
-                fill_value=_nodata(window_data.data.dtype),
-            )
-            canvas_data.mask = True
 
-            canvas = PixelCollection(
-                canvas_data, canvas_bounds, None, window_data.colormap
-            )
+def _paste(window, canvas_data, canvas_mask):
+    """Copy valid window pixels into unfilled canvas pixels in place.
 
-        # paste the resulting data onto a canvas
-        canvas = paste(
-            PixelCollection(
-                window_data.data.astype(canvas.data.dtype),
-                window_data.bounds,
-                window_data.band,
-                window_data.colormap,
-            ),
-            canvas,
-        )
-        sources_used.append(source)
+    canvas_mask tracks unfilled pixels and is updated to reflect the pixels
+    that were filled.
+    """
+    window_data = np.ma.getdata(window)
+    window_mask = np.ma.getmask(window)
 
-        if not canvas.data.mask.any():
-            # stop if all pixels are valid
-            break
+    if window_mask is np.ma.nomask:
+        np.copyto(canvas_data, window_data, casting="unsafe", where=canvas_mask)
+        canvas_mask.fill(False)
+        return
 
-    return map(lambda s: (s.name, s.url), sources_used), canvas
+    # unfilled & ~masked
+    fill = np.greater(canvas_mask, window_mask)
+    np.copyto(canvas_data, window_data, casting="unsafe", where=fill)
+    np.logical_and(canvas_mask, window_mask, out=canvas_mask)
 
 
 def paste(window_pixels, canvas_pixels):
-    """ "Reproject" src data into the correct position within a larger image"""
+    """ "Reproject" src data into the correct position within a larger image.
+
+    The canvas is updated in place (and returned).
+    """
     window_data, (window_bounds, window_crs), band, window_colormap = window_pixels
     canvas, (canvas_bounds, canvas_crs), _, canvas_colormap = canvas_pixels
     if window_crs != canvas_crs:
@@ -150,18 +399,17 @@ def paste(window_pixels, canvas_pixels):
         )
 
     if band is None:
-        merged = np.ma.where(canvas.mask & ~window_data.mask, window_data, canvas)
-        merged.fill_value = canvas.fill_value
+        _paste(window_data, np.ma.getdata(canvas), np.ma.getmaskarray(canvas))
     else:
-        merged_band = np.ma.where(
-            canvas.mask[band] & ~window_data.mask, window_data, canvas[band]
+        _paste(
+            window_data[0],
+            np.ma.getdata(canvas)[band],
+            np.ma.getmaskarray(canvas)[band],
         )
-        canvas[band] = merged_band[0]
-        merged = canvas
 
     # drop colormaps if they differ between sources
     colormap = None
     if window_colormap == canvas_colormap:
         colormap = canvas_colormap
 
-    return PixelCollection(merged, canvas_pixels.bounds, None, colormap)
+    return PixelCollection(canvas, canvas_pixels.bounds, None, colormap)
@@ -0,0 +1,183 @@
+# coding=utf-8
+from __future__ import absolute_import, division
+
+import logging
+import os
+import threading
+from collections import deque
+from concurrent import futures
+
+from .stats import METRICS, clock
+
+LOG = logging.getLogger(__name__)
+# seconds between deadline checks while waiting for results
+POLL_INTERVAL = 0.1
+
+
+def _result(future, deadline):
+    """Wait for a future's result, checking deadline (so that cancellation is
+    noticed, even when it's unbounded in time) every POLL_INTERVAL seconds."""
+    while True:
+        remaining = deadline.remaining()
+        timeout = POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining)
+
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            deadline.check()
+
+
+class ReadPool(object):
+    """Long-lived thread pool shared by all reads.
+
+    Arguments:
+        max_workers {int} -- Number of worker threads.
+
+    Keyword Arguments:
+        queue_depth {int} -- Maximum number of submitted (queued + running)
+            tasks; submit() blocks when this is reached. (default: {None})
+        concurrency {int} -- Default maximum number of tasks in flight for a
+            single map() call. (default: {None})
+        name {str} -- Name to record queue wait times under. (default: {None})
+    """
+
+    def __init__(self, max_workers, queue_depth=None, concurrency=None, name=None):
+        self.max_workers = max_workers
+        self.name = name
+        self.queue_depth = queue_depth
+        self.concurrency = concurrency
+
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = None
+        if queue_depth:
+            self._slots = threading.BoundedSemaphore(queue_depth)
+
+        self._submitted = 0
+        self._started = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def executor(self):
+        with self._lock:
+            # threads don't survive fork(); start a new executor in children
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers
+                )
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def _record_wait(self, wait):
+        with self._lock:
+            self._started += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+        if self.name:
+            METRICS.timing(self.name + ".queue_wait_seconds", wait)
+
+    def _done(self, future):
+        with self._lock:
+            if future.cancelled():
+                self._cancelled += 1
+            else:
+                self._completed += 1
+
+        if self._slots is not None:
+            self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit fn for execution, blocking if the queue is full."""
+        if self._slots is not None:
+            self._slots.acquire()
+
+        queued_at = clock()
+
+        def _run():
+            self._record_wait(clock() - queued_at)
+
+            return fn(*args, **kwargs)
+
+        with self._lock:
+            self._submitted += 1
+
+        try:
+            future = self.executor.submit(_run)
+            # release slots from a callback so that cancelled tasks free theirs
+            future.add_done_callback(self._done)
+
+            return future
+        except Exception:
+            with self._lock:
+                self._submitted -= 1
+
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+    def imap(self, fn, iterable, lookahead=None, deadline=None):
+        """Lazily apply fn to each item of iterable, yielding results in input
+        order.
+
+        At most lookahead tasks (or the pool's concurrency, whichever is
+        smaller) are in flight at a time; items are only consumed from
+        iterable as results are yielded. Tasks that haven't started are
+        cancelled when the generator is closed.
+
+        When a deadline (deadline.Deadline) is provided, it's checked while
+        waiting for results, so waiting stops when it's cancelled or passes;
+        tasks that are already running are left to finish in the background.
+        """
+        limits = [x for x in (lookahead, self.concurrency) if x]
+        lookahead = min(limits) if limits else None
+        items = iter(iterable)
+        pending = deque()
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and (
+                    lookahead is None or len(pending) < lookahead
+                ):
+                    try:
+                        pending.append(self.submit(fn, next(items)))
+                    except StopIteration:
+                        exhausted = True
+
+                if not pending:
+                    return
+
+                future = pending.popleft()
+
+                if deadline is None:
+                    yield future.result()
+                else:
+                    yield _result(future, deadline)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def map(self, fn, iterable, concurrency=None):
+        """Apply fn to each item of iterable, keeping at most concurrency
+        tasks in flight, and return a list of results in input order."""
+        return list(self.imap(fn, iterable, lookahead=concurrency))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "submitted": self._submitted,
+                "queued": self._submitted - self._started - self._cancelled,
+                "running": self._started - self._completed,
+                "completed": self._completed,
+                "cancelled": self._cancelled,
+                "queue_wait_total": self._wait_total,
+                "queue_wait_max": self._wait_max,
+                "queue_wait_mean": self._wait_total / max(1, self._started),
+            }
@@ -1,7 +1,6 @@
 # coding=utf-8
 from __future__ import absolute_import, division, print_function
 
-import itertools
 import logging
 from builtins import range
 from functools import reduce
@@ -234,73 +233,73 @@ def _reduce_landsat_windows(canvas, window):
     return paste(pixels, canvas)
 
 
-def postprocess(windows):
+def _merge_landsat_windows(windows):
     from . import _nodata
 
-    windows = list(filter(None, windows))
-
-    landsat_windows = filter(lambda sw: "LC08_" in sw[0].url, windows)
-    landsat_windows = dict(
-        [
-            (k, list(v))
-            for k, v in itertools.groupby(
-                landsat_windows, lambda x: x[0].url.split("/")[-2]
-            )
-        ]
+    source, pixels = windows[0]
+    source = Source(
+        "/".join(source.url.split("/")[0:-1]),
+        source.name,
+        source.resolution,
+        source.band_info,
+        source.meta,
+        source.recipes,
+        source.acquired_at,
+        None,
+        source.priority,
+        source.coverage,
     )
 
-    pan_bands = dict(
-        list(
-            map(
-                lambda sw: (sw[0].url.split("/")[-2], sw[1]),
-                filter(lambda sw: sw[0].band == 4, filter(None, windows)),
-            )
-        )
+    ws = filter(lambda sw: is_rgb(sw[0].band), windows)
+    canvas_data = np.ma.zeros(
+        (3,) + pixels.data.shape[1:],
+        dtype=pixels.data.dtype,
+        fill_value=_nodata(pixels.data.dtype),
     )
+    canvas_data.mask = True
+
+    canvas = PixelCollection(canvas_data, pixels.bounds)
+    pixels = reduce(_reduce_landsat_windows, ws, canvas)
+
+    pan = [sw[1] for sw in windows if sw[0].band == 4]
+
+    if pan:
+        pansharpened, _ = Brovey(pixels.data, pan[0].data[0], 0.2, pan[0].data.dtype)
+
+        return source, PixelCollection(pansharpened, pixels.bounds)
+
+    return source, pixels
+
+
+def postprocess(windows):
+    """Merge per-band Landsat 8 windows into a single window per scene.
+
+    windows is consumed lazily; all other windows are yielded as soon as
+    they're available. Band windows for a scene are expected to be adjacent (as
+    produced by preprocess).
+    """
+    scene_id = None
+    scene_windows = []
 
-    for source, pixels in windows:
+    for source, pixels in filter(None, windows):
         if pixels is None or pixels.data is None:
             continue
 
         if "landsat8" in source.recipes:
-            scene_id = source.url.split("/")[-2]
-            source = Source(
-                "/".join(source.url.split("/")[0:-1]),
-                source.name,
-                source.resolution,
-                source.band_info,
-                source.meta,
-                source.recipes,
-                source.acquired_at,
-                None,
-                source.priority,
-                source.coverage,
-            )
+            if source.url.split("/")[-2] != scene_id and scene_windows:
+                yield _merge_landsat_windows(scene_windows)
+                scene_windows = []
 
-            # pick out all bands for the same scene the first time it's seen
-            if scene_id in landsat_windows:
-                ws = filter(
-                    lambda sw: is_rgb(sw[0].band), landsat_windows.pop(scene_id)
-                )
-                canvas_data = np.ma.zeros(
-                    (3,) + pixels.data.shape[1:],
-                    dtype=pixels.data.dtype,
-                    fill_value=_nodata(pixels.data.dtype),
-                )
-                canvas_data.mask = True
+            scene_id = source.url.split("/")[-2]
+            scene_windows.append((source, pixels))
+            continue
 
-                canvas = PixelCollection(canvas_data, pixels.bounds)
-                pixels = reduce(_reduce_landsat_windows, ws, canvas)
+        if scene_windows:
+            yield _merge_landsat_windows(scene_windows)
+            scene_id = None
+            scene_windows = []
 
-                if scene_id in pan_bands:
-                    pan = pan_bands[scene_id]
+        yield source, pixels
 
-                    pansharpened, _ = Brovey(
-                        pixels.data, pan.data[0], 0.2, pan.data.dtype
-                    )
-
-                    yield source, PixelCollection(pansharpened, pixels.bounds)
-                else:
-                    yield source, pixels
-        else:
-            yield source, pixels
+    if scene_windows:
+        yield _merge_landsat_windows(scene_windows)
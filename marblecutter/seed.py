@@ -0,0 +1,445 @@
+# coding=utf-8
+"""Render a region's tiles to an MBTiles file or a directory."""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import importlib
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+
+import mercantile
+import rasterio
+
+from . import InvalidTileRequest, NoDataAvailable
+from .tiling import render_metatile, render_tile
+
+LOG = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/tiff": "tif",
+    "image/webp": "webp",
+}
+
+FORMATS = {
+    "geotiff": "marblecutter.formats.geotiff:GeoTIFF",
+    "jpeg": "marblecutter.formats.jpeg:JPEG",
+    "optimal": "marblecutter.formats.optimal:Optimal",
+    "png": "marblecutter.formats.png:PNG",
+    "webp": "marblecutter.formats.webp:WebP",
+}
+
+# per-worker state, populated by _init_worker
+_worker = {}
+
+
+def _load(spec):
+    """Load an object from a module:name spec."""
+    module, name = spec.split(":")
+
+    return getattr(importlib.import_module(module), name)
+
+
+class DirectorySink(object):
+    """Writes tiles to {z}/{x}/{y}.{ext} within a directory.
+
+    Tiles without data are recorded as empty {z}/{x}/{y}.empty files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, tile, ext):
+        return os.path.join(
+            self.path, str(tile.z), str(tile.x), "{}.{}".format(tile.y, ext)
+        )
+
+    def exists(self, tile):
+        return any(
+            os.path.exists(self._filename(tile, ext))
+            for ext in list(EXTENSIONS.values()) + ["bin", "empty"]
+        )
+
+    def skip(self, tile):
+        self._write(self._filename(tile, "empty"), b"")
+
+    def write(self, tile, content_type, data):
+        self._write(self._filename(tile, EXTENSIONS.get(content_type, "bin")), data)
+
+    def _write(self, filename, data):
+        dirname = os.path.dirname(filename)
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+
+        os.rename(tmp, filename)
+
+    def close(self):
+        pass
+
+
+class MBTilesSink(object):
+    """Writes tiles to an MBTiles file.
+
+    The format metadata is set from the content type of the first tile
+    written. Tiles without data are recorded in an empty_tiles table (with the
+    same columns as tiles, less tile_data).
+    """
+
+    def __init__(self, path, metadata=None, commit_interval=100):
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._content_type = None
+        self._mixed = False
+        self._conn = sqlite3.connect(path)
+
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)"
+            )
+            self._conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)"
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tiles (
+                  zoom_level INTEGER,
+                  tile_column INTEGER,
+                  tile_row INTEGER,
+                  tile_data BLOB
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE UNIQUE INDEX IF NOT EXISTS tile_index
+                  ON tiles (zoom_level, tile_column, tile_row)
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS empty_tiles (
+                  zoom_level INTEGER,
+                  tile_column INTEGER,
+                  tile_row INTEGER,
+                  PRIMARY KEY (zoom_level, tile_column, tile_row)
+                )
+                """
+            )
+
+            for name, value in (metadata or {}).items():
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                    (name, str(value)),
+                )
+
+    @staticmethod
+    def _row(tile):
+        # MBTiles uses TMS-style rows
+        return (tile.z, tile.x, (2 ** tile.z) - 1 - tile.y)
+
+    def exists(self, tile):
+        cur = self._conn.execute(
+            """
+            SELECT 1 FROM tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+            UNION ALL
+            SELECT 1 FROM empty_tiles
+            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+            """,
+            self._row(tile) * 2,
+        )
+
+        return cur.fetchone() is not None
+
+    def skip(self, tile):
+        self._conn.execute(
+            """
+            INSERT OR REPLACE INTO empty_tiles (zoom_level, tile_column, tile_row)
+            VALUES (?, ?, ?)
+            """,
+            self._row(tile),
+        )
+        self._changed()
+
+    def write(self, tile, content_type, data):
+        if self._content_type is None:
+            self._content_type = content_type
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                ("format", EXTENSIONS.get(content_type, content_type)),
+            )
+        elif content_type != self._content_type and not self._mixed:
+            LOG.warning(
+                "Writing %s tiles alongside %s ones; format metadata is %s",
+                content_type,
+                self._content_type,
+                EXTENSIONS.get(self._content_type, self._content_type),
+            )
+            self._mixed = True
+
+        self._conn.execute(
+            """
+            INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data)
+            VALUES (?, ?, ?, ?)
+            """,
+            self._row(tile) + (sqlite3.Binary(data),),
+        )
+        self._changed()
+
+    def _changed(self):
+        """Commit every commit_interval changes."""
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def _init_worker(catalog, transformation, format, scale, metatile):
+    # one GDAL environment per worker, kept open for its lifetime
+    env = rasterio.Env()
+    env.__enter__()
+
+    _worker.update(
+        {
+            "env": env,
+            "catalog": _load(catalog)(),
+            "transformation": _load(transformation)() if transformation else None,
+            "format": _load(format)(),
+            "scale": scale,
+            "metatile": metatile,
+        }
+    )
+
+
+def _render(tiles):
+    """Render a group of tiles (sharing a metatile, if metatiling).
+
+    Returns a list of (tile, content type, data) tuples, a list of tiles
+    without data and a count of failures.
+    """
+    rendered = []
+    empty = []
+    failures = 0
+    catalog = _worker["catalog"]
+    kwargs = {
+        "transformation": _worker["transformation"],
+        "format": _worker["format"],
+        "scale": _worker["scale"],
+    }
+
+    try:
+        if _worker["metatile"] > 1:
+            results = render_metatile(
+                tiles[0], catalog, size=_worker["metatile"], **kwargs
+            )
+        else:
+            results = dict(
+                (tile, render_tile(tile, catalog, **kwargs)) for tile in tiles
+            )
+
+        for tile in tiles:
+            if tile in results:
+                headers, data = results[tile]
+                rendered.append((tile, headers["Content-Type"], bytes(data)))
+    except (InvalidTileRequest, NoDataAvailable):
+        empty.extend(tiles)
+    except Exception as e:
+        LOG.exception("Failed to render %s: %s", tiles, e)
+        failures += len(tiles)
+
+    return rendered, empty, failures
+
+
+def _groups(tiles, metatile):
+    """Group tiles by the metatile they belong to."""
+    groups = {}
+    order = []
+
+    for tile in tiles:
+        size = min(metatile, 2 ** tile.z)
+        key = (tile.z, tile.x // size, tile.y // size)
+
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+
+        groups[key].append(tile)
+
+    return [groups[key] for key in order]
+
+
+def seed(
+    bbox,
+    zooms,
+    sink,
+    catalog,
+    transformation=None,
+    format=FORMATS["png"],
+    scale=1,
+    metatile=1,
+    processes=None,
+    report_interval=10,
+):
+    """Render all tiles intersecting bbox at the provided zooms to sink,
+    skipping tiles that the sink already contains.
+
+    Tiles without data are recorded by the sink (see its skip()), so they're
+    skipped when resuming too. Failed tiles are retried.
+
+    catalog, transformation and format are module:name specs that are loaded
+    (and called without arguments) in each worker process.
+
+    Returns:
+        (int, int) -- Tuple of tiles rendered and failures.
+    """
+    tiles = [t for t in mercantile.tiles(*bbox, zooms=zooms) if not sink.exists(t)]
+    groups = _groups(tiles, metatile)
+
+    LOG.info("Rendering %d tiles (%d groups)", len(tiles), len(groups))
+
+    pool = multiprocessing.Pool(
+        processes or multiprocessing.cpu_count(),
+        initializer=_init_worker,
+        initargs=(catalog, transformation, format, scale, metatile),
+    )
+
+    count = empties = failures = 0
+    start = last_report = time.time()
+
+    try:
+        for rendered, empty, failed in pool.imap_unordered(_render, groups):
+            failures += failed
+
+            for (tile, content_type, data) in rendered:
+                sink.write(tile, content_type, data)
+                count += 1
+
+            for tile in empty:
+                sink.skip(tile)
+                empties += 1
+
+            now = time.time()
+            if now - last_report >= report_interval:
+                LOG.info(
+                    "%d tiles rendered (%d failed); %.1f tiles/s",
+                    count,
+                    failures,
+                    count / (now - start),
+                )
+                last_report = now
+
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        sink.close()
+
+    elapsed = time.time() - start
+    LOG.info(
+        "Done: %d tiles rendered (%d empty, %d failed) in %.1fs; %.1f tiles/s",
+        count,
+        empties,
+        failures,
+        elapsed,
+        count / max(elapsed, 1e-9),
+    )
+
+    return count, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("WEST", "SOUTH", "EAST", "NORTH"),
+        required=True,
+        help="Bounding box (in WGS84)",
+    )
+    parser.add_argument("--min-zoom", type=int, required=True)
+    parser.add_argument("--max-zoom", type=int, required=True)
+    parser.add_argument(
+        "--catalog",
+        default="marblecutter.catalogs.postgis:PostGISCatalog",
+        help="Catalog class or factory (module:name)",
+    )
+    parser.add_argument(
+        "--transformation",
+        help="Transformation class or factory (module:name); defaults to "
+        "marblecutter.transformations:Image for image formats",
+    )
+    parser.add_argument(
+        "--format",
+        default="png",
+        help="Output format ({}) or format factory (module:name)".format(
+            ", ".join(sorted(FORMATS.keys()))
+        ),
+    )
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument(
+        "--metatile", type=int, default=1, help="Metatile size (in tiles)"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of worker processes",
+    )
+    parser.add_argument(
+        "output", help="Output path (*.mbtiles for MBTiles, otherwise a directory)"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+
+    format = FORMATS.get(args.format, args.format)
+    transformation = args.transformation
+    if transformation is None and args.format in ("jpeg", "optimal", "png", "webp"):
+        transformation = "marblecutter.transformations:Image"
+
+    if args.output.endswith(".mbtiles"):
+        sink = MBTilesSink(
+            args.output,
+            metadata={
+                "name": os.path.splitext(os.path.basename(args.output))[0],
+                "bounds": ",".join(map(str, args.bbox)),
+                "minzoom": args.min_zoom,
+                "maxzoom": args.max_zoom,
+            },
+        )
+    else:
+        sink = DirectorySink(args.output)
+
+    seed(
+        args.bbox,
+        range(args.min_zoom, args.max_zoom + 1),
+        sink,
+        args.catalog,
+        transformation=transformation,
+        format=format,
+        scale=args.scale,
+        metatile=args.metatile,
+        processes=args.processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
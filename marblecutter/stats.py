@@ -1,11 +1,396 @@
+# coding=utf-8
+"""Timers and metrics.
+
+Measurements are recorded with METRICS (a Metrics instance), which forwards
+them to its sinks: an in-process Aggregator (which keeps histograms that can be
+queried for percentiles or rendered in the Prometheus text format) and,
+optionally, a StatsdSink.
+"""
+from __future__ import absolute_import, division
+
+import bisect
+import logging
+import os
+import re
+import socket
+import threading
 import time
 
+LOG = logging.getLogger(__name__)
+
+# monotonic, high-resolution clock (Python 2 only has time.time)
+clock = getattr(time, "perf_counter", time.time)
+
+# upper bounds of histogram buckets
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = tuple(2 ** i for i in range(10, 31, 2))
+
 
 class Timer(object):
     def __enter__(self):
-        self.start = time.time()
+        self.start = clock()
         return self
 
     def __exit__(self, ty, val, tb):
-        self.end = time.time()
+        self.end = clock()
         self.elapsed = self.end - self.start
+
+
+def _slug(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+class Histogram(object):
+    """Bucketed distribution of observed values.
+
+    Keyword Arguments:
+        buckets {tuple} -- Sorted bucket upper bounds.
+            (default: {DURATION_BUCKETS})
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for values beyond the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, q):
+        """Estimate the qth (0-100) percentile by interpolating within the
+        bucket containing it."""
+        if self.count == 0:
+            return None
+
+        rank = q / 100 * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else self.min
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                lower = max(lower, self.min)
+                upper = min(upper, self.max)
+
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.max
+
+    def cumulative(self):
+        """Get (upper bound, cumulative count) pairs, ending with +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Aggregator(object):
+    """In-process sink that keeps histograms and counters per metric and set
+    of tags."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name, value, tags, buckets):
+        key = (name, tuple(sorted(tags.items())))
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+
+            histogram.observe(value)
+
+    def increment(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+
+        with self._lock:
+            self._gauges[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+    def histogram(self, name, **tags):
+        with self._lock:
+            return self._histograms.get((name, tuple(sorted(tags.items()))))
+
+    def percentile(self, name, q, **tags):
+        histogram = self.histogram(name, **tags)
+
+        if histogram is None:
+            return None
+
+        with self._lock:
+            return histogram.percentile(q)
+
+    def snapshot(self, percentiles=(50, 90, 99)):
+        """Summarize all metrics.
+
+        Returns:
+            dict -- Mapping of metric names to lists of dicts containing tags
+                and counts (and, for histograms, sums and percentiles) or, for
+                gauges, values.
+        """
+        summary = {}
+
+        with self._lock:
+            for (name, tags), histogram in sorted(self._histograms.items()):
+                entry = {
+                    "tags": dict(tags),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "min": histogram.min,
+                    "max": histogram.max,
+                }
+                for q in percentiles:
+                    entry["p{}".format(q)] = histogram.percentile(q)
+
+                summary.setdefault(name, []).append(entry)
+
+            for (name, tags), value in sorted(self._counters.items()):
+                summary.setdefault(name, []).append(
+                    {"tags": dict(tags), "count": value}
+                )
+
+            for (name, tags), value in sorted(self._gauges.items()):
+                summary.setdefault(name, []).append(
+                    {"tags": dict(tags), "value": value}
+                )
+
+        return summary
+
+    def prometheus(self, prefix="marblecutter"):
+        """Render metrics in the Prometheus text exposition format."""
+        with self._lock:
+            lines = (
+                self._prometheus_histograms(prefix)
+                + self._prometheus_counters(prefix)
+                + self._prometheus_gauges(prefix)
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def _prometheus_histograms(self, prefix):
+        lines = []
+        typed = set()
+
+        for (name, tags), histogram in sorted(self._histograms.items()):
+            metric = _prometheus_name(prefix, name)
+            if metric not in typed:
+                lines.append("# TYPE {} histogram".format(metric))
+                typed.add(metric)
+
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        metric, _prometheus_labels(tags, le=le), total
+                    )
+                )
+
+            labels = _prometheus_labels(tags)
+            lines.append("{}_sum{} {!r}".format(metric, labels, histogram.sum))
+            lines.append("{}_count{} {}".format(metric, labels, histogram.count))
+
+        return lines
+
+    def _prometheus_counters(self, prefix):
+        return _prometheus_values(
+            "counter",
+            [
+                (_prometheus_name(prefix, name) + "_total", tags, value)
+                for (name, tags), value in sorted(self._counters.items())
+            ],
+        )
+
+    def _prometheus_gauges(self, prefix):
+        return _prometheus_values(
+            "gauge",
+            [
+                (_prometheus_name(prefix, name), tags, value)
+                for (name, tags), value in sorted(self._gauges.items())
+            ],
+        )
+
+
+def _prometheus_name(prefix, name):
+    return "{}_{}".format(prefix, _slug(name)) if prefix else _slug(name)
+
+
+def _prometheus_labels(tags, **extra):
+    labels = list(tags) + sorted(extra.items())
+    if not labels:
+        return ""
+
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                k,
+                str(v)
+                .replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n"),
+            )
+            for (k, v) in labels
+        )
+    )
+
+
+def _prometheus_values(metric_type, values):
+    """Render (metric, tags, value) tuples of a type with a single value per
+    series (counters and gauges)."""
+    lines = []
+    typed = set()
+
+    for (metric, tags, value) in values:
+        if metric not in typed:
+            lines.append("# TYPE {} {}".format(metric, metric_type))
+            typed.add(metric)
+
+        lines.append("{}{} {}".format(metric, _prometheus_labels(tags), value))
+
+    return lines
+
+
+class StatsdSink(object):
+    """Sends measurements to a statsd-compatible daemon over UDP (with
+    DogStatsD-style tags).
+
+    Arguments:
+        host {str} -- statsd host.
+
+    Keyword Arguments:
+        port {int} -- statsd port. (default: {8125})
+        prefix {str} -- Prefix for metric names. (default: {"marblecutter"})
+    """
+
+    def __init__(self, host, port=8125, prefix="marblecutter"):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _send(self, name, value, kind, tags):
+        packet = "{}{}:{}|{}".format(
+            self.prefix + "." if self.prefix else "", name, value, kind
+        )
+
+        if tags:
+            packet += "|#" + ",".join(
+                "{}:{}".format(k, v) for (k, v) in sorted(tags.items())
+            )
+
+        try:
+            self._socket.sendto(packet.encode("utf-8"), self.address)
+        except (IOError, OSError) as e:
+            # metrics are best-effort
+            LOG.debug("Unable to send %s: %s", packet, e)
+
+    def observe(self, name, value, tags, buckets):
+        if name.endswith("_seconds"):
+            value = "{:0.3f}".format(value * 1000)
+            self._send(name[: -len("_seconds")], value, "ms", tags)
+        else:
+            self._send(name, value, "h", tags)
+
+    def increment(self, name, value, tags):
+        self._send(name, value, "c", tags)
+
+    def gauge(self, name, value, tags):
+        self._send(name, value, "g", tags)
+
+
+class Metrics(object):
+    """Records measurements to a set of sinks.
+
+    Keyword Arguments:
+        sinks {list} -- Sinks (implementing observe, increment and gauge).
+            (default: {None})
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+
+    @property
+    def aggregator(self):
+        """The first in-process Aggregator sink, if any."""
+        for sink in self.sinks:
+            if isinstance(sink, Aggregator):
+                return sink
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **tags):
+        for sink in self.sinks:
+            sink.observe(name, value, tags, buckets)
+
+    def timing(self, name, seconds, **tags):
+        """Record a duration (names should end in _seconds)."""
+        self.observe(name, seconds, DURATION_BUCKETS, **tags)
+
+    def size(self, name, size, **tags):
+        """Record a size (names should end in _bytes)."""
+        self.observe(name, size, SIZE_BUCKETS, **tags)
+
+    def increment(self, name, value=1, **tags):
+        for sink in self.sinks:
+            sink.increment(name, value, tags)
+
+    def gauge(self, name, value, **tags):
+        """Record a current value (e.g. the amount of something in use)."""
+        for sink in self.sinks:
+            sink.gauge(name, value, tags)
+
+    def stages(self, timings, prefix="render"):
+        """Record (stage name, seconds) pairs, as collected by render."""
+        for (stage, elapsed) in timings:
+            self.timing(prefix + ".stage_seconds", elapsed, stage=_slug(stage))
+
+
+def _default_sinks():
+    sinks = [Aggregator()]
+
+    statsd = os.getenv("MARBLECUTTER_STATSD_HOST")
+    if statsd:
+        host, _, port = statsd.partition(":")
+        sinks.append(StatsdSink(host, int(port or 8125)))
+
+    return sinks
+
+
+METRICS = Metrics(_default_sinks())
@@ -7,7 +7,19 @@ import mercantile
 from affine import Affine
 from rasterio.crs import CRS
 
-from . import Bounds, render
+from . import (
+    Bounds,
+    _format,
+    _headers,
+    _isempty,
+    _isimage,
+    _render,
+    _reserve,
+    render,
+)
+from .cache import fingerprint
+from .stats import METRICS, Timer
+from .utils import PixelCollection
 
 LOG = logging.getLogger(__name__)
 TILE_SHAPE = (256, 256)
@@ -15,7 +27,58 @@ WEB_MERCATOR_CRS = CRS.from_epsg(3857)
 WGS84_CRS = CRS.from_epsg(4326)
 
 
-def render_tile(tile, catalog, transformation=None, format=None, scale=1, expand=True):
+def tile_cache_key(
+    tile,
+    catalog,
+    transformation=None,
+    format=None,
+    scale=1,
+    expand=True,
+):
+    """Generate a key identifying a rendered tile.
+
+    Catalogs are identified by their `cache_key` (which includes their
+    `version`), so changing a catalog's version invalidates its cached tiles.
+    """
+    return fingerprint(
+        tuple(tile), catalog, transformation, format, scale, expand
+    )
+
+
+def _from_cache(key, cached, elapsed):
+    """Produce a response from a cached tile."""
+    headers, data = cached
+    headers = dict(headers)
+    headers["ETag"] = '"{}"'.format(key)
+    headers["Server-Timing"] = [
+        'op0;desc="Cache Hit";dur={:0.2f}'.format(elapsed * 1000)
+    ]
+
+    return headers, data
+
+
+def _to_cache(cache, key, headers, data):
+    """Cache a rendered tile (sans per-response headers)."""
+    headers["ETag"] = '"{}"'.format(key)
+    cache.set(
+        key,
+        dict((k, v) for k, v in headers.items() if k not in ("ETag", "Server-Timing")),
+        data,
+    )
+
+    return headers, data
+
+
+def render_tile(
+    tile,
+    catalog,
+    transformation=None,
+    format=None,
+    scale=1,
+    expand=True,
+    cache=None,
+    deadline=None,
+):
     """Render a tile into Web Mercator.
 
     Arguments:
@@ -27,6 +90,8 @@ def render_tile(tile, catalog, transformation=None, format=None, scale=1, expand
         format {function} -- Output format. (default: {None})
         scale {int} -- Output scale factor. (default: {1})
         expand {bool} -- Whether to expand single-band, paletted sources to RGBA. (default: {True})
+        cache {cache.MemoryTileCache} -- Cache for rendered tiles. (default: {None})
+        deadline {deadline.Deadline} -- Deadline / cancellation token. (default: {None})
 
     Returns:
         (dict, bytes) -- Tuple of HTTP headers (dict) and bytes.
@@ -37,7 +102,30 @@ def render_tile(tile, catalog, transformation=None, format=None, scale=1, expand
 
     catalog.validate(tile)
 
-    return render(
+    if cache is None:
+        return render(
+            bounds,
+            shape,
+            WEB_MERCATOR_CRS,
+            catalog=catalog,
+            format=format,
+            transformation=transformation,
+            expand=expand,
+            deadline=deadline,
+        )
+
+    with Timer() as t:
+        key = tile_cache_key(tile, catalog, transformation, format, scale, expand)
+        cached = cache.get(key)
+
+    METRICS.increment(
+        "tile_cache.lookups", result="miss" if cached is None else "hit"
+    )
+
+    if cached is not None:
+        return _from_cache(key, cached, t.elapsed)
+
+    headers, data = render(
         bounds,
         shape,
         WEB_MERCATOR_CRS,
@@ -45,8 +133,15 @@ def render_tile(tile, catalog, transformation=None, format=None, scale=1, expand
         format=format,
         transformation=transformation,
         expand=expand,
+        deadline=deadline,
     )
 
+    if deadline is not None and deadline.truncated:
+        # don't cache partial results
+        return headers, data
+
+    return _to_cache(cache, key, headers, data)
+
 
 def render_tile_from_sources(
     tile, sources, transformation=None, format=None, scale=1, expand=True
@@ -78,3 +173,133 @@ def render_tile_from_sources(
         transformation=transformation,
         expand=expand,
     )
+
+
+def _metatile(tile, size):
+    """Determine the tiles making up the size x size metatile containing tile."""
+    size = min(size, 2 ** tile.z)
+    x = tile.x - tile.x % size
+    y = tile.y - tile.y % size
+
+    return (x, y), [
+        mercantile.Tile(x + dx, y + dy, tile.z)
+        for dy in range(size)
+        for dx in range(size)
+    ]
+
+
+def _crop_tile(pixels, data_format, tile, origin, shape):
+    """Slice a tile out of a metatile's pixels.
+
+    Whether RGBA images are empty was decided for the whole metatile, so it's
+    decided again for each tile (as the Image transformation would have if the
+    tile had been rendered on its own).
+
+    Returns:
+        (PixelCollection, str) -- Tuple of the tile's pixels and data format.
+    """
+    # avoid circular dependencies
+    from .transformations.image import transparent
+
+    height, width = shape
+    top = (tile.y - origin[1]) * height
+    left = (tile.x - origin[0]) * width
+
+    if _isimage(data_format):
+        data = pixels.data[top:top + height, left:left + width]
+
+        if (
+            data_format.upper() == "RGBA"
+            and not _isempty(data)
+            and not data[:, :, 3].any()
+        ):
+            data = transparent(data.shape[:2])
+    else:
+        data = pixels.data[:, top:top + height, left:left + width]
+
+    return (
+        PixelCollection(
+            data,
+            Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS),
+            pixels.band,
+            pixels.colormap,
+        ),
+        data_format,
+    )
+
+
+def render_metatile(
+    tile, catalog, size=4, transformation=None, format=None, scale=1, expand=True
+):
+    """Render the metatile containing a tile into Web Mercator.
+
+    The size x size block of tiles containing tile is rendered in a single
+    pass (so buffers are only applied at the metatile's edges) and then sliced
+    into individual tiles.
+
+    Arguments:
+        tile {mercantile.Tile} -- Tile to render.
+        catalog {catalogs.Catalog} -- Catalog to load sources from.
+
+    Keyword Arguments:
+        size {int} -- Width / height of the metatile (in tiles). (default: {4})
+        transformation {Transformation} -- Transformation to apply. (default: {None})
+        format {function} -- Output format. (default: {None})
+        scale {int} -- Output scale factor. (default: {1})
+        expand {bool} -- Whether to expand single-band, paletted sources to
+            RGBA. (default: {True})
+
+    Returns:
+        dict -- Dict of mercantile.Tile to tuples of HTTP headers (dict) and bytes.
+    """
+    catalog.validate(tile)
+
+    origin, tiles = _metatile(tile, size)
+    ul = mercantile.xy_bounds(tiles[0])
+    lr = mercantile.xy_bounds(tiles[-1])
+    bounds = Bounds((ul.left, lr.bottom, lr.right, ul.top), WEB_MERCATOR_CRS)
+    tile_shape = tuple(map(int, Affine.scale(scale) * TILE_SHAPE))
+    n = int(len(tiles) ** 0.5)
+    shape = (tile_shape[0] * n, tile_shape[1] * n)
+
+    with _reserve(bounds, shape, transformation):
+        pixels, data_format, sources_used, stats, details = _render(
+            bounds,
+            shape,
+            WEB_MERCATOR_CRS,
+            expand,
+            catalog=catalog,
+            transformation=transformation,
+        )
+
+        METRICS.stages(stats)
+        rendered = {}
+
+        for t in tiles:
+            try:
+                catalog.validate(t)
+            except Exception:
+                continue
+
+            tile_pixels, tile_format = _crop_tile(
+                pixels, data_format, t, origin, tile_shape
+            )
+
+            with Timer() as timer:
+                (content_type, formatted) = _format(
+                    format, tile_pixels, tile_format, sources_used
+                )
+
+            METRICS.stages([("Format", timer.elapsed)])
+
+            rendered[t] = (
+                _headers(
+                    content_type,
+                    stats + [("Format", timer.elapsed)],
+                    sources_used,
+                    details,
+                ),
+                formatted,
+            )
+
+    return rendered
@@ -2,17 +2,41 @@
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
-from rasterio.plot import reshape_as_image
 
 from .. import PixelCollection
 from .utils import Transformation
 
 
+def _interleave(data, count):
+    """Convert band-style data into a contiguous, pixel-interleaved uint8 array
+    (in a single pass, casting as necessary)."""
+    (_, height, width) = data.shape
+    out = np.empty((height, width, count), np.uint8)
+    np.copyto(out, np.moveaxis(data[0:count], 0, -1), casting="unsafe")
+
+    return out
+
+
+def transparent(shape):
+    """Produce a fully transparent RGBA image.
+
+    The image is a read-only view of a single pixel, so it doesn't take up
+    memory and can be recognized (see marblecutter._isempty) without scanning
+    it.
+    """
+    return np.broadcast_to(np.zeros(4, np.uint8), tuple(shape) + (4,))
+
+
 class Image(Transformation):
+    """Transforms 3 or 4 band data into RGBA images.
+
+    Pixels are opaque unless one of their bands was masked. When everything
+    was, the image is a constant, transparent one (see transparent()).
+    """
 
     def transform(self, pixels):
         data = pixels.data
-        (count, _, _) = data.shape
+        (count, height, width) = data.shape
 
         if 3 > count > 4:
             raise Exception("Source data must be 3 or 4 bands")
@@ -22,13 +46,30 @@ class Image(Transformation):
             data *= np.iinfo(np.uint8).max
 
         if count == 4:
-            rgba = reshape_as_image(data.astype(np.uint8))
-            return PixelCollection(rgba, pixels.bounds), "RGBA"
+            return (
+                PixelCollection(_interleave(np.ma.getdata(data), 4), pixels.bounds),
+                "RGBA",
+            )
+
+        # decide from the mask accumulated while compositing
+        mask = np.ma.getmask(data)
 
-        rgb = reshape_as_image(data.astype(np.uint8))
-        if data.mask.any():
-            a = np.logical_and.reduce(~data.mask).astype(np.uint8) * 255
+        if mask is np.ma.nomask or not mask.any():
+            opaque = True
         else:
-            a = np.full((rgb.shape[:-1]), 255, np.uint8)
+            # pixels are only opaque if no bands were masked
+            opaque = ~mask.any(axis=0)
+
+            if not opaque.any():
+                return (
+                    PixelCollection(transparent((height, width)), pixels.bounds),
+                    "RGBA",
+                )
+
+        rgba = np.empty((height, width, 4), np.uint8)
+        np.copyto(
+            rgba[:, :, 0:3], np.moveaxis(np.ma.getdata(data), 0, -1), casting="unsafe"
+        )
+        np.multiply(opaque, 255, out=rgba[:, :, 3], casting="unsafe")
 
-        return PixelCollection(np.dstack((rgb, a)), pixels.bounds), "RGBA"
+        return PixelCollection(rgba, pixels.bounds), "RGBA"
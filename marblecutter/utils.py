@@ -7,6 +7,9 @@ Bounds = namedtuple("Bounds", ["bounds", "crs"])
 # TODO add colorinterp and copy from src.colorinterp
 PixelCollection = namedtuple("PixelCollection", ["data", "bounds", "band", "colormap"])
 PixelCollection.__new__.__defaults__ = (None, None)
+WarpPlan = namedtuple(
+    "WarpPlan", ["resolution", "resampling", "src_nodata", "add_alpha"]
+)
 Source = namedtuple(
     "Source",
     [
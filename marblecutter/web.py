@@ -7,7 +7,13 @@ import types
 from flask import Blueprint, Markup, jsonify, request, render_template
 from flask import url_for as _url_for
 
-from . import InvalidTileRequest, NoCatalogAvailable, NoDataAvailable
+from . import (
+    DeadlineExceeded,
+    InsufficientMemory,
+    InvalidTileRequest,
+    NoCatalogAvailable,
+    NoDataAvailable,
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -62,6 +68,20 @@ def handle_no_catalog_available(error):
     return "", 404
 
 
+@bp.app_errorhandler(DeadlineExceeded)
+def handle_deadline_exceeded(error):
+    LOG.warning("Deadline exceeded: %s", error)
+
+    return "", 504
+
+
+@bp.app_errorhandler(InsufficientMemory)
+def handle_insufficient_memory(error):
+    LOG.warning("Rejecting request: %s", error)
+
+    return "", 503, {"Retry-After": "1"}
+
+
 @bp.app_errorhandler(IOError)
 def handle_ioerror(error):
     LOG.exception(error)
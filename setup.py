@@ -13,6 +13,7 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     package_data={"marblecutter": ["static/images/*", "templates/*"]},
+    entry_points={"console_scripts": ["marblecutter-seed = marblecutter.seed:main"]},
     install_requires=[
         "future",
         "haversine",
@@ -29,6 +30,7 @@ setup(
     extras_require={
         "color_ramp": "matplotlib",
         "postgis": "psycopg2",
+        "test": ["pytest"],
         "web": ["flask"],
         # TODO eventually move to environment markers, per https://hynek.me/articles/conditional-python-dependencies/
         ":python_version<'3.0'": ["futures"],
@@ -0,0 +1,39 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from marblecutter.cache import FileSystemTileCache, fingerprint
+
+
+class Node(object):
+    def __init__(self, value):
+        self.value = value
+        self.parent = None
+
+
+def test_fingerprint_handles_cycles():
+    node = Node(1)
+    node.parent = node
+    items = [1]
+    items.append(items)
+
+    assert fingerprint(node) == fingerprint(node)
+    assert fingerprint(node) != fingerprint(Node(1))
+    assert fingerprint(items) == fingerprint(items)
+
+
+def test_fingerprint_describes_shared_values():
+    shared = {"a": 1}
+
+    assert fingerprint([shared, shared]) == fingerprint([{"a": 1}, {"a": 1}])
+
+
+def test_file_system_tile_cache_clear(tmpdir):
+    cache = FileSystemTileCache(str(tmpdir))
+    cache.set("abcdef", {"Content-Type": "image/png"}, b"tile")
+
+    assert cache.get("abcdef") == ({"Content-Type": "image/png"}, b"tile")
+
+    cache.clear()
+
+    assert cache.get("abcdef") is None
+    assert cache.stats()["size"] == 0
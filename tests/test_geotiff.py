@@ -0,0 +1,47 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import numpy as np
+from rasterio.io import MemoryFile
+
+from marblecutter import WEB_MERCATOR_CRS
+from marblecutter.formats.geotiff import GeoTIFF, _fill
+from marblecutter.utils import Bounds, PixelCollection
+
+
+def _masked():
+    data = np.ma.masked_array(
+        np.arange(16, dtype=np.uint8).reshape(1, 4, 4), fill_value=255
+    )
+    data[0, 0] = np.ma.masked
+
+    return data
+
+
+def test_fill_copies_by_default():
+    data = _masked()
+    filled = _fill(data)
+
+    assert (filled[0, 0] == 255).all()
+    assert (data.data[0, 0] == np.arange(4)).all()
+
+
+def test_fill_in_place():
+    data = _masked()
+    filled = _fill(data, inplace=True)
+
+    assert np.shares_memory(filled, data)
+    assert (data.data[0, 0] == 255).all()
+    assert data.mask[0, 0].all()
+
+
+def test_geotiff_leaves_pixels_unchanged():
+    data = _masked()
+    bounds = Bounds((0, 0, 1000, 1000), WEB_MERCATOR_CRS)
+
+    (_, tiff) = GeoTIFF()(PixelCollection(data, bounds), "raw", [])
+
+    assert (data.data[0, 0] == np.arange(4)).all()
+
+    with MemoryFile(tiff) as memfile, memfile.open() as dataset:
+        assert (dataset.read(1)[0] == 255).all()
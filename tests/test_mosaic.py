@@ -0,0 +1,56 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from marblecutter.catalogs import WGS84_CRS
+from marblecutter.mosaic import plan
+from marblecutter.utils import Bounds, Source
+
+BOUNDS = Bounds((0, 0, 1, 1), WGS84_CRS)
+SHAPE = (256, 256)
+
+
+def _source(url, footprint, **meta):
+    west, south, east, north = footprint
+
+    return Source(
+        url,
+        url,
+        1,
+        meta=meta,
+        geom={
+            "type": "Polygon",
+            "coordinates": [
+                [
+                    [west, south],
+                    [east, south],
+                    [east, north],
+                    [west, north],
+                    [west, south],
+                ]
+            ],
+        },
+    )
+
+
+def test_opaque_sources_hide_sources_beneath_them():
+    top = _source("top", (-1, -1, 2, 2), opaque=True)
+    partial = _source("partial", (0.5, 0, 2, 1), opaque=True)
+    beneath = _source("beneath", (0, 0, 1, 1))
+
+    selected, skipped = plan([partial, top, beneath], BOUNDS, SHAPE)
+
+    assert selected == [partial, top]
+    assert skipped == [beneath]
+
+
+def test_transparent_sources_are_all_read():
+    sources = [
+        _source("top", (-1, -1, 2, 2)),
+        _source("beneath", (0, 0, 1, 1)),
+        _source("elsewhere", (5, 5, 6, 6)),
+    ]
+
+    selected, skipped = plan(iter(sources), BOUNDS, SHAPE)
+
+    assert selected == sources
+    assert skipped == []
@@ -0,0 +1,47 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import numpy as np
+
+from marblecutter.formats.optimal import Optimal
+from marblecutter.transformations.image import transparent
+from marblecutter.utils import PixelCollection
+
+
+def _rgba(alpha):
+    data = np.zeros((256, 256, 4), np.uint8)
+    data[:, :, 0] = np.arange(256)
+    data[:, :, 3] = alpha
+
+    return PixelCollection(data, None)
+
+
+def test_opaque_rgba_is_jpeg():
+    (content_type, _) = Optimal()(_rgba(255), "RGBA", [])
+
+    assert content_type == "image/jpeg"
+
+
+def test_partially_transparent_rgba_is_png():
+    pixels = _rgba(255)
+    pixels.data[255, 255, 3] = 0
+
+    (content_type, _) = Optimal()(pixels, "RGBA", [])
+
+    assert content_type == "image/png"
+
+
+def test_empty_rgba_is_png():
+    (content_type, _) = Optimal()(
+        PixelCollection(transparent((256, 256)), None), "RGBA", []
+    )
+
+    assert content_type == "image/png"
+
+
+def test_rgb_is_jpeg():
+    (content_type, _) = Optimal()(
+        PixelCollection(np.zeros((256, 256, 3), np.uint8), None), "RGB", []
+    )
+
+    assert content_type == "image/jpeg"
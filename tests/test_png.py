@@ -0,0 +1,55 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from marblecutter.formats.png import PNG
+from marblecutter.utils import PixelCollection
+
+
+def _imagery(size):
+    """Smooth, noisy RGB data (with more than 256 colors), like imagery."""
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:size, 0:size]
+    data = np.stack(
+        [
+            (x + y) // 4,
+            (x * 2) % 256,
+            128 + 64 * np.sin(x / 17.0) * np.cos(y / 23.0),
+        ],
+        axis=2,
+    )
+
+    return np.clip(data + rng.normal(0, 6, data.shape), 0, 255).astype(np.uint8)
+
+
+def _pil(data, data_format):
+    out = BytesIO()
+    Image.fromarray(data, data_format).save(out, "png")
+
+    return out.getvalue()
+
+
+def _decode(data):
+    return np.asarray(Image.open(BytesIO(data)))
+
+
+@pytest.mark.parametrize("size", [256, 512])
+@pytest.mark.parametrize("data_format", ["RGB", "RGBA"])
+def test_no_larger_than_pil(size, data_format):
+    data = _imagery(size)
+
+    if data_format == "RGBA":
+        # partially transparent
+        alpha = np.full((size, size), 255, np.uint8)
+        alpha[: size // 4] = 0
+        data = np.dstack((data, alpha))
+
+    (_, png) = PNG()(PixelCollection(data, None), data_format, [])
+
+    assert (_decode(png) == data).all()
+    assert len(png) <= len(_pil(data, data_format))
@@ -0,0 +1,42 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+
+import pytest
+
+from marblecutter import RenderCancelled
+from marblecutter.deadline import Deadline
+from marblecutter.pool import ReadPool
+
+
+def test_imap_stops_waiting_when_cancelled():
+    pool = ReadPool(2)
+    deadline = Deadline()
+    release = threading.Event()
+
+    def _read(x):
+        release.wait(5)
+        return x
+
+    reads = pool.imap(_read, range(2), deadline=deadline)
+    threading.Timer(0.2, deadline.cancel).start()
+    started = time.time()
+
+    try:
+        with pytest.raises(RenderCancelled):
+            next(reads)
+    finally:
+        release.set()
+        reads.close()
+
+    assert time.time() - started < 2
+
+
+def test_imap_yields_results_in_order():
+    pool = ReadPool(4)
+
+    assert list(pool.imap(lambda x: x * 2, range(10), deadline=Deadline())) == [
+        x * 2 for x in range(10)
+    ]
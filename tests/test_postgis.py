@@ -0,0 +1,195 @@
+# coding=utf-8
+"""PostGISCatalog queries, run against a PostGIS database identified by
+MARBLECUTTER_TEST_DATABASE_URL (skipped when it isn't set)."""
+from __future__ import absolute_import
+
+import os
+
+import mercantile
+import pytest
+
+from marblecutter import WEB_MERCATOR_CRS, get_resolution_in_meters
+from marblecutter.catalogs import WGS84_CRS
+from marblecutter.utils import Bounds
+
+DATABASE_URL = os.getenv("MARBLECUTTER_TEST_DATABASE_URL")
+TABLE = "marblecutter_test_footprints"
+
+pytestmark = pytest.mark.skipif(
+    DATABASE_URL is None, reason="MARBLECUTTER_TEST_DATABASE_URL isn't set"
+)
+
+# (source, url, resolution, meta, acquired_at, priority, mask, footprint,
+# min_zoom, max_zoom, enabled); masks and footprints are (west, south, east,
+# north)
+FOOTPRINTS = [
+    ("a", "a.tif", 10, None, "2017-01-01", 1, None, (0, 0, 4, 7), 0, 22, True),
+    (
+        "b",
+        "b.tif",
+        5,
+        '{"x": 1}',
+        "2018-01-01",
+        0.5,
+        (4, 0, 5, 2),
+        (3, 0, 8, 4),
+        0,
+        22,
+        True,
+    ),
+    ("c", "c.tif", 20, None, None, None, None, (0, 0, 8, 7), 0, 22, True),
+    ("d", "d.tif", 1, None, "2019-01-01", 0.9, None, (5, 3, 8, 7), 0, 22, True),
+    ("e", "e.tif", 1, None, "2019-01-01", 0.9, None, (0, 0, 8, 7), 0, 22, False),
+    ("f", "f.tif", 1, None, "2019-01-01", 0.9, None, (0, 0, 8, 7), 15, 22, True),
+    ("g", "g.tif", 1, None, "2016-01-01", 0.1, None, (0, 0, 8, 7), 0, 5, True),
+]
+
+
+def _envelope(bounds):
+    if bounds is None:
+        return "NULL"
+
+    return "ST_MakeEnvelope({}, {}, {}, {}, 4326)".format(*bounds)
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    psycopg2 = pytest.importorskip("psycopg2")
+
+    from marblecutter.catalogs.postgis import PostGISCatalog
+
+    connection = psycopg2.connect(DATABASE_URL)
+    connection.autocommit = True
+
+    with connection.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+        cur.execute("DROP TABLE IF EXISTS {}".format(TABLE))
+        cur.execute(
+            """
+            CREATE TABLE {} (
+              source text,
+              url text,
+              filename text,
+              resolution double precision,
+              bands jsonb,
+              meta jsonb,
+              recipes jsonb,
+              acquired_at timestamp,
+              priority double precision,
+              mask geometry,
+              geom geometry,
+              min_zoom integer,
+              max_zoom integer,
+              enabled boolean
+            )
+            """.format(TABLE)
+        )
+
+        for (
+            source,
+            url,
+            resolution,
+            meta,
+            acquired_at,
+            priority,
+            mask,
+            footprint,
+            min_zoom,
+            max_zoom,
+            enabled,
+        ) in FOOTPRINTS:
+            cur.execute(
+                """
+                INSERT INTO {} (source, url, resolution, meta, acquired_at,
+                  priority, mask, geom, min_zoom, max_zoom, enabled)
+                VALUES (%s, %s, %s, %s, %s, %s, {}, {}, %s, %s, %s)
+                """.format(TABLE, _envelope(mask), _envelope(footprint)),
+                (
+                    source,
+                    url,
+                    resolution,
+                    meta,
+                    acquired_at,
+                    priority,
+                    min_zoom,
+                    max_zoom,
+                    enabled,
+                ),
+            )
+
+    yield lambda **kwargs: PostGISCatalog(
+        table=TABLE, database_url=DATABASE_URL, **kwargs
+    )
+
+    with connection.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS {}".format(TABLE))
+
+    connection.close()
+
+
+def _tile_query(tile):
+    bounds = Bounds(mercantile.xy_bounds(tile), WEB_MERCATOR_CRS)
+    return bounds, get_resolution_in_meters(bounds, (256, 256))
+
+
+@pytest.mark.parametrize("include_geometries", [True, False])
+def test_fill_bounds_batch_matches_fill_bounds(catalog, include_geometries):
+    catalog = catalog()
+    bounds_list = [
+        Bounds(b, WGS84_CRS)
+        for b in [
+            (0, 0, 8, 7),
+            (0, 0, 2, 2),
+            (4, 0, 6, 3),
+            (5, 4, 7, 6),
+            (2, 2, 6, 6),
+            (7, 6, 8, 7),
+        ]
+    ]
+    resolution = (1000, 1000)
+
+    batch = catalog._fill_bounds_batch(
+        bounds_list, resolution, include_geometries=include_geometries
+    )
+
+    assert len(batch) == len(bounds_list)
+
+    for bounds, sources in zip(bounds_list, batch):
+        expected = list(
+            catalog._fill_bounds(
+                bounds, resolution, include_geometries=include_geometries
+            )
+        )
+
+        assert expected
+        assert sources == expected
+
+
+def test_fill_bounds_batch_without_bounds(catalog):
+    assert catalog()._fill_bounds_batch([], (1000, 1000)) == []
+
+
+def test_fill_bounds_includes_zoom_ranges(catalog):
+    sources = list(
+        catalog()._fill_bounds(Bounds((0, 0, 8, 7), WGS84_CRS), (1000, 1000))
+    )
+
+    assert sources
+    assert all(s.min_zoom is not None and s.max_zoom is not None for s in sources)
+
+
+def test_reused_parent_sources_are_filtered_by_zoom(catalog):
+    parent = mercantile.Tile(16, 15, 5)
+    child = mercantile.Tile(32, 31, 6)
+
+    direct = catalog(include_geometries=True)
+    cached = catalog(include_geometries=True, cache_size=16, reuse_parent=True)
+
+    assert "g.tif" in [s.url for s in cached.get_sources(*_tile_query(parent))]
+
+    expected = list(direct.get_sources(*_tile_query(child)))
+    reused = cached.get_sources(*_tile_query(child))
+
+    assert "g.tif" not in [s.url for s in expected]
+    assert "g.tif" not in [s.url for s in reused]
+    assert all(s.min_zoom <= child.z <= s.max_zoom for s in reused)
@@ -0,0 +1,73 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import sqlite3
+
+import mercantile
+
+from marblecutter.seed import DirectorySink, MBTilesSink, _groups
+
+
+def test_groups_by_metatile():
+    tiles = list(mercantile.tiles(-180, -85, 180, 85, zooms=[3]))
+    groups = _groups(tiles, 4)
+
+    assert len(groups) == 4
+    assert sorted(t for group in groups for t in group) == sorted(tiles)
+
+    for group in groups:
+        assert len(group) == 16
+        assert len(set((t.x // 4, t.y // 4) for t in group)) == 1
+
+
+def test_groups_at_low_zooms():
+    # metatiles are no larger than the world
+    tiles = list(mercantile.tiles(-180, -85, 180, 85, zooms=[0, 1]))
+    groups = _groups(tiles, 4)
+
+    assert [len(group) for group in groups] == [1, 4]
+
+
+def test_groups_without_metatiling():
+    tiles = list(mercantile.tiles(-180, -85, 180, 85, zooms=[2]))
+
+    assert _groups(tiles, 1) == [[tile] for tile in tiles]
+
+
+def test_mbtiles_rows_are_flipped():
+    assert MBTilesSink._row(mercantile.Tile(0, 0, 0)) == (0, 0, 0)
+    assert MBTilesSink._row(mercantile.Tile(1, 0, 1)) == (1, 1, 1)
+    assert MBTilesSink._row(mercantile.Tile(3, 5, 3)) == (3, 3, 2)
+
+
+def test_mbtiles_format_and_empty_tiles(tmpdir):
+    path = str(tmpdir.join("test.mbtiles"))
+    written = mercantile.Tile(1, 0, 1)
+    empty = mercantile.Tile(0, 0, 1)
+
+    sink = MBTilesSink(path, metadata={"name": "test"})
+    sink.write(written, "image/jpeg", b"tile")
+    sink.skip(empty)
+    sink.close()
+
+    sink = MBTilesSink(path)
+    assert sink.exists(written)
+    assert sink.exists(empty)
+    assert not sink.exists(mercantile.Tile(1, 1, 1))
+    sink.close()
+
+    conn = sqlite3.connect(path)
+    metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+    conn.close()
+
+    assert metadata == {"name": "test", "format": "jpg"}
+
+
+def test_directory_empty_tiles(tmpdir):
+    sink = DirectorySink(str(tmpdir))
+    tile = mercantile.Tile(1, 0, 1)
+
+    sink.skip(tile)
+
+    assert sink.exists(tile)
+    assert tmpdir.join("1", "1", "0.empty").check()